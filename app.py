@@ -2,40 +2,103 @@ from os import environ
 from ast import Assign
 from multiprocessing.util import ForkAwareThreadLock
 from unittest.mock import NonCallableMagicMock
-from db import db, Asset, Job, Rating, User, Chat, Message
-from flask import Flask, request
+from db import db, Asset, Job, Rating, User, Chat, Message, JOB_TRANSITIONS, RATES
+from flask import Flask, Response, g, request, Request, stream_with_context
+from functools import wraps
+from io import BytesIO
+import base64
+import click
 import json
+import math
+import sys
 import users_dao
+import chats_dao
+import jobs_dao
+import broker
+import message_buffer
+import presence
+import cache
+import serializer
+import passwords
+import search
+import migrations
+import images
 import datetime
 from flask_socketio import SocketIO, emit, join_room, rooms
+from sqlalchemy.pool import QueuePool
+import email_notif
 from email_notif import send_email
  
  
+class InMemoryRequest(Request):
+    """
+    Request that keeps uploaded files in memory instead of temporary files,
+    since MAX_CONTENT_LENGTH caps their size before they are read
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
+
 app = Flask(__name__)
+app.request_class = InMemoryRequest
 db_filename = "hack.db"
  
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
+#Heroku style postgres:// urls are not accepted by SQLAlchemy
+database_url = environ.get("DATABASE_URL", "sqlite:///%s" % db_filename).replace("postgres://", "postgresql://", 1)
+app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": int(environ.get("DB_POOL_SIZE", 10)),
+    "max_overflow": int(environ.get("DB_MAX_OVERFLOW", 20)),
+    "pool_pre_ping": environ.get("DB_POOL_PRE_PING", "true").lower() == "true",
+    "pool_recycle": int(environ.get("DB_POOL_RECYCLE", 1800))
+}
+if database_url.startswith("sqlite"):
+    #SQLAlchemy 1.4 gives file databases a NullPool, reopening the file on every checkout
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["poolclass"] = QueuePool
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {"check_same_thread": False}
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = False
 app.config['SECRET_KEY'] = 'mysecret'
-socketio = SocketIO(app)
+app.config["MAX_CONTENT_LENGTH"] = int(environ.get("MAX_REQUEST_BYTES", 16 * 1024 * 1024))
+app.config["EMAIL_TRANSPORT"] = environ.get("EMAIL_TRANSPORT", "sendgrid")
+#Processes serving the chat websocket share rooms and emits through this
+#message queue: redis://host:port/0, broker://host:port (see broker.py) or
+#any other url Flask-SocketIO supports. Without one, only a single process can serve the chat
+SOCKETIO_MESSAGE_QUEUE = environ.get("SOCKETIO_MESSAGE_QUEUE")
+SOCKETIO_ASYNC_MODE = environ.get("SOCKETIO_ASYNC_MODE")
+if SOCKETIO_MESSAGE_QUEUE and SOCKETIO_MESSAGE_QUEUE.startswith("broker://"):
+    socketio = SocketIO(app, async_mode=SOCKETIO_ASYNC_MODE, client_manager=broker.BrokerManager(SOCKETIO_MESSAGE_QUEUE))
+else:
+    socketio = SocketIO(app, async_mode=SOCKETIO_ASYNC_MODE, message_queue=SOCKETIO_MESSAGE_QUEUE)
 
 db.init_app(app)
-with app.app_context():
-    db.create_all()
+#The password workers (see passwords.py) import this file again as __mp_main__
+#when the server was started with "python app.py". They only hash passwords,
+#so they skip setting up the database and starting background threads
+if __name__ != "__mp_main__":
+    passwords.init_app(socketio)
+    with app.app_context():
+        db.create_all()
+        migrations.upgrade()
+        search.init_search_index()
+        search.init_location_index()
+        cache.init_versions()
+    email_notif.init_app(app)
+    images.init_app(app)
+    message_buffer.init_app(app)
+    presence.init_app(app, socketio)
  
 def success_response(data, code=200):
     """
     Returns a generic success response
     """
-    return json.dumps(data), code
+    return serializer.dumps(data), code
 
  
 def failure_response(message, code=404):
     """
     Returns a generic failure response
     """
-    return json.dumps({"error": message}), code
+    return serializer.dumps({"error": message}), code
  
 def extract_token(request):
     """
@@ -51,6 +114,197 @@ def extract_token(request):
         return False, failure_response("Invalid authorization header", 400)
  
     return True, bearer_token
+
+def requires_session(endpoint):
+    """
+    Decorator for endpoints that need a valid session token in the header
+
+    Stores the token and the id of its user in g.session_token and g.user_id
+    """
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        success, session_token = extract_token(request)
+        if not success:
+            return failure_response("Could not extract session token", 400)
+
+        user_id = users_dao.get_user_id_by_session_token(session_token)
+        if user_id is None:
+            return failure_response("Session token Invalid", 400)
+
+        g.session_token = session_token
+        g.user_id = user_id
+        return endpoint(*args, **kwargs)
+    return wrapper
+
+def requires_session_user(endpoint):
+    """
+    Decorator for endpoints that need the user of a valid session token
+
+    Works like requires_session and also stores the user in g.user. Returns 401
+    if the user was deleted while another process still had the token cached
+    """
+    @wraps(endpoint)
+    @requires_session
+    def wrapper(*args, **kwargs):
+        user = User.query.filter_by(id = g.user_id).first()
+        if user is None:
+            users_dao.invalidate_session(g.session_token)
+            return failure_response("User of the session no longer exists", 401)
+
+        g.user = user
+        return endpoint(*args, **kwargs)
+    return wrapper
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+DEFAULT_RADIUS_KM = 5
+MAX_RADIUS_KM = 50
+STREAM_BATCH_SIZE = 500
+DEFAULT_HISTORY_SIZE = 50
+MAX_HISTORY_SIZE = 200
+
+def encode_cursor(job):
+    """
+    Helper function that encodes the position of a job in the feed as an opaque token
+    """
+    position = f"{job.date_created.isoformat()}|{job.id}"
+    return base64.urlsafe_b64encode(position.encode("utf8")).decode("utf8")
+
+def decode_cursor(cursor):
+    """
+    Helper function that decodes a feed token back into its (date_created, id) position
+    """
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode("utf8")).decode("utf8")
+        date_created, job_id = position.split("|")
+        return True, (datetime.datetime.fromisoformat(date_created), int(job_id))
+    except ValueError:
+        return False, failure_response("Invalid cursor", 400)
+
+def filter_jobs_by(query):
+    """
+    Helper function that applies the "status" (comma separated statuses) and
+    "category" query parameters to a job query
+
+    The statuses are rendered into the SQL, so the partial indexes on open jobs
+    can be used. The category, which comes from clients unchecked, stays a
+    bound parameter
+    """
+    status = request.args.get("status")
+    if status is not None:
+        statuses = [name.strip() for name in status.split(",") if name.strip()]
+        unknown = [name for name in statuses if name not in JOB_TRANSITIONS]
+        if not statuses:
+            return False, failure_response("Missing status", 400)
+        if unknown:
+            return False, failure_response(f"Unknown status: {', '.join(unknown)}", 400)
+        if len(statuses) == 1:
+            query = query.filter(Job.status == db.bindparam("status", statuses[0], literal_execute=True))
+        else:
+            query = query.filter(Job.status.in_(db.bindparam("statuses", statuses, expanding=True, literal_execute=True)))
+    category = request.args.get("category")
+    if category is not None:
+        query = query.filter(Job.category == category)
+    return True, query
+
+def paginate_jobs(query):
+    """
+    Helper function that applies keyset pagination (newest first) to a job query
+
+    Reads the "limit" and "cursor" query parameters and returns the page of
+    jobs along with the cursor for the next page, or None if this is the last page
+    """
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        success, position = decode_cursor(cursor)
+        if not success:
+            return False, position
+        date_created, job_id = position
+        query = query.filter(db.or_(
+            Job.date_created < date_created,
+            db.and_(Job.date_created == date_created, Job.id < job_id)
+        ))
+
+    jobs = query.order_by(Job.date_created.desc(), Job.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(jobs[limit - 1]) if len(jobs) > limit else None
+    return True, (jobs[:limit], next_cursor)
+
+def history_size(value):
+    """
+    Helper function that clamps a requested number of chat messages to
+    [1, MAX_HISTORY_SIZE], defaulting to DEFAULT_HISTORY_SIZE
+    """
+    try:
+        size = int(value) if value is not None else DEFAULT_HISTORY_SIZE
+    except (TypeError, ValueError):
+        size = DEFAULT_HISTORY_SIZE
+    return min(max(size, 1), MAX_HISTORY_SIZE)
+
+def parse_rate(value):
+    """
+    Helper function that checks a rate is a whole number in RATES, accepting
+    whole floats such as 4.0 from clients that send every number as a double
+
+    Returns if the rate is valid, and the rate as an int
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value not in RATES:
+        return False, None
+    return True, value
+
+def list_response(key, query, serialize):
+    """
+    Helper function that returns the serialized rows of a query as {key: [...]}
+
+    If the "stream" query parameter is "true" the rows are fetched
+    STREAM_BATCH_SIZE at a time and sent as they are encoded, so memory use
+    does not grow with the number of rows
+    """
+    if request.args.get("stream") == "true":
+        rows = (serialize(row) for row in query.yield_per(STREAM_BATCH_SIZE))
+        return Response(stream_with_context(serializer.iter_list(key, rows)), mimetype="application/json")
+    return success_response({key: [serialize(row) for row in query.all()]})
+
+def extract_fields(model):
+    """
+    Helper function that reads the "fields" or "view" query parameter of a request
+
+    Returns the names of the requested columns of the model, or None if the
+    full serialized form was requested
+    """
+    fields = request.args.get("fields")
+    view = request.args.get("view")
+    if fields is not None:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+    elif view == "simple":
+        names = list(model.SIMPLE_FIELDS)
+    elif view is None or view == "full":
+        return True, None
+    else:
+        return False, failure_response("Unknown view", 400)
+
+    unknown = [name for name in names if name not in model.projection()]
+    if not names or unknown:
+        return False, failure_response(f"Unknown fields: {', '.join(unknown)}", 400)
+    return True, names
+
+def project(model, names):
+    """
+    Helper function that builds a query selecting only the named columns of a model
+    """
+    columns = model.projection()
+    return db.session.query(*[columns[name].label(name) for name in names])
+
+def project_row(row, names):
+    """
+    Helper function that turns a projected row into a dictionary of the named columns
+    """
+    values = row._asdict()
+    return {name: values[name] for name in names}
  
 @app.route("/")
 def hello_world():
@@ -126,41 +380,23 @@ def update_session():
  
  
 @app.route("/api/secret/", methods=["GET"])
+@requires_session
 def secret_message():
     """
     Endpoint for verifying a session token and returning a secret message
  
-    In your project, you will use the same logic for any endpoint that needs
-    authentication
+    Any endpoint that needs authentication can use the requires_session decorator
     """
-    success, session_token = extract_token(request)
-    if not success:
-        return failure_response("Could not extract session token", 400)
-   
-    user = users_dao.get_user_by_session_token(session_token)
-    if user is None or not user.verify_session_token(session_token):
-        return failure_response("Session token Invalid", 400)
- 
     return success_response({"message": "You have successfully implemented sessions!"})
  
  
 @app.route("/api/logout/", methods=["POST"])
+@requires_session_user
 def logout():
     """
     Endpoint for logging out a user
     """
-    success, session_token = extract_token(request)
- 
-    if not success:
-        return failure_response("Could not extract session token", 400)
- 
-    user = users_dao.get_user_by_session_token(session_token)
-    if user is None or not user.verify_session_token(session_token):
-        return failure_response("Invalid session token", 400)
- 
-    user.session_token = ""
-    user.session_expiration = datetime.datetime.now()
-    user.update_token = ""
+    users_dao.end_session(g.user)
  
     return success_response({"message": "You have successfully logged out"})
 
@@ -169,8 +405,12 @@ def get_users():
     """
     Endpoint for the getting all users
     """
-    user = [user.serialize() for user in User.query.all()]
-    return success_response({"user": user})
+    success, fields = extract_fields(User)
+    if not success:
+        return fields
+    if fields is not None:
+        return list_response("user", project(User, fields), lambda row: project_row(row, fields))
+    return list_response("user", User.query.options(*User.serialize_options()), lambda user: user.serialize())
 
 @app.route("/api/user/<int:user_id>/", methods = ["POST"])
 def update_user(user_id):
@@ -195,11 +435,20 @@ def update_user(user_id):
     return success_response(user.serialize(), 200)
 
 @app.route("/api/user/<int:user_id>/")
+@cache.cached("user", "asset", "asset_variant", "job", "rating", "chat", "message")
 def get_user(user_id):
     """
     Endpoint for getting a user by id
     """
-    user = User.query.filter_by(id = user_id).first()
+    success, fields = extract_fields(User)
+    if not success:
+        return fields
+    if fields is not None:
+        row = project(User, fields).filter(User.id == user_id).first()
+        if row is None:
+            return failure_response("User not found!")
+        return success_response(project_row(row, fields))
+    user = User.query.options(*User.serialize_options()).filter_by(id = user_id).first()
     if user is None:
         return failure_response("User not found!")
     return success_response(user.serialize())
@@ -212,20 +461,27 @@ def delete_user(user_id):
     user = User.query.filter_by(id = user_id).first()
     if user is None:
         return failure_response("User not found!")
+    session_token = user.session_token
     db.session.delete(user)
     db.session.commit()
+    users_dao.invalidate_session(session_token)
     return success_response(user.serialize())
     
 
 #-----------------IMAGES--------------------------------------------
 
 @app.route("/api/asset/")
+@cache.cached("asset", "asset_variant")
 def get_assets():
     """
     Endpoint for getting all assets
     """
-    assets = [asset.serialize() for asset in Asset.query.all()]
-    return success_response({"assets": assets})
+    success, fields = extract_fields(Asset)
+    if not success:
+        return fields
+    if fields is not None:
+        return list_response("assets", project(Asset, fields), lambda row: project_row(row, fields))
+    return list_response("assets", Asset.query.options(*Asset.serialize_options()), lambda asset: asset.serialize())
 
 @app.route("/api/user/<int:user_id>/upload/", methods=["POST"])
 def upload_user(user_id):
@@ -245,36 +501,172 @@ def upload_user(user_id):
     asset = Asset(image_data = image_data, user_id = user_id)
     db.session.add(asset)
     db.session.commit()
+    images.generate_variants(asset)
+    return success_response(asset.serialize(), 201)
+
+def upload_file(**owner):
+    """
+    Helper function that stores the image in the body of a request, sent either
+    as multipart/form-data in an "image" field or as the raw bytes of the image
+    """
+    if request.content_length is not None and request.content_length > images.MAX_UPLOAD_BYTES:
+        return failure_response("Image is too large", 413)
+
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("image")
+        if upload is None:
+            return failure_response("No image found", 400)
+        stream = upload.stream
+    else:
+        stream = request.stream
+
+    img_data = images.read_upload(stream)
+    if img_data is None:
+        return failure_response("Image is too large", 413)
+    ext = images.validate_image(img_data)
+    if ext is None:
+        return failure_response("Unsupported image type", 400)
+
+    asset = Asset(image_bytes = img_data, extension = ext, **owner)
+    db.session.add(asset)
+    db.session.commit()
+    images.generate_variants(asset)
     return success_response(asset.serialize(), 201)
 
+@app.route("/api/user/<int:user_id>/upload/file/", methods=["POST"])
+def upload_user_file(user_id):
+    """
+    Endpoint for uploading an image file to storage for users, sent as
+    multipart/form-data or as raw bytes
+    """
+    user = User.query.filter_by(id = user_id).first()
+    if user is None:
+        return failure_response("User not found!")
+    return upload_file(user_id = user_id)
+
+@app.route("/api/job/<int:job_id>/upload/file/", methods=["POST"])
+def upload_job_file(job_id):
+    """
+    Endpoint for uploading an image file to storage for jobs, sent as
+    multipart/form-data or as raw bytes
+    """
+    job = Job.query.filter_by(id = job_id).first()
+    if job is None:
+        return failure_response("Job not found!")
+    return upload_file(job_id = job_id)
+
 @app.route("/api/asset/<int:asset_id>/")
 def get_asset(asset_id):
     """
     Endpoint for getting a asset by id
     """
-    asset = Asset.query.filter_by(id = asset_id).first()
+    success, fields = extract_fields(Asset)
+    if not success:
+        return fields
+    if fields is not None:
+        row = project(Asset, fields).filter(Asset.id == asset_id).first()
+        if row is None:
+            return failure_response("Asset not found!")
+        return success_response(project_row(row, fields))
+    asset = Asset.query.options(*Asset.serialize_options()).filter_by(id = asset_id).first()
+    if asset is None:
+        return failure_response("Asset not found!")
+    return success_response(asset.serialize())
+
+@app.route("/api/asset/<int:asset_id>/", methods=["DELETE"])
+def delete_asset(asset_id):
+    """
+    Endpoint for deleting an asset by id
+    """
+    asset = Asset.query.options(*Asset.serialize_options()).filter_by(id = asset_id).first()
     if asset is None:
         return failure_response("Asset not found!")
+    db.session.delete(asset)
+    db.session.commit()
     return success_response(asset.serialize())
 
 #-----------------JOBS--------------------------------------------
 @app.route("/api/job/filter/")
 def filter_jobs():
     """
-    Endpoint for doing a search bar filter
+    Endpoint for doing a search bar filter, best match first
     """
-    body = json.loads(request.data)
-    search = body["search"]
-    jobs = [job.serialize() for job in Job.query.filter(Job.title.like(search)).all()]
-    return success_response({"jobs": jobs})
+    search_text = request.args.get("search")
+    if search_text is None and request.data:
+        search_text = json.loads(request.data).get("search")
+    if search_text is None:
+        return failure_response("Missing search", 400)
+
+    limit = min(max(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    jobs = search.search_jobs(search_text, limit + 1, offset)
+    next_offset = offset + limit if len(jobs) > limit else None
+    return success_response({"jobs": [job.serialize() for job in jobs[:limit]], "next_offset": next_offset})
+
+@app.route("/api/job/nearby/")
+def get_nearby_jobs():
+    """
+    Endpoint for getting the jobs within a radius of a point, closest first
+    """
+    latitude = request.args.get("latitude")
+    longtitude = request.args.get("longtitude")
+    if latitude is None or longtitude is None:
+        return failure_response("Missing latitude or longtitude", 400)
+    success, coordinates = jobs_dao.validate_coordinates(latitude, longtitude)
+    if not success:
+        return failure_response(coordinates, 400)
+    latitude, longtitude = coordinates
+    radius = request.args.get("radius", DEFAULT_RADIUS_KM, type=float)
+    if radius is None or not math.isfinite(radius):
+        return failure_response("radius must be a number", 400)
+    radius = min(max(radius, 0), MAX_RADIUS_KM)
+
+    limit = min(max(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    nearby = search.jobs_near(latitude, longtitude, radius, limit + 1, offset)
+    next_offset = offset + limit if len(nearby) > limit else None
+    jobs = [dict(job.serialize(), distance=distance) for job, distance in nearby[:limit]]
+    return success_response({"jobs": jobs, "next_offset": next_offset})
 
 @app.route("/api/job/")
+@cache.cached("job", "user_profile", "asset", "asset_variant")
 def get_jobs():
     """
-    Endpoint for getting all jobs
+    Endpoint for getting a page of the job feed, newest first
     """
-    jobs = [job.serialize() for job in Job.query.all()]
-    return success_response({"jobs": jobs})
+    success, fields = extract_fields(Job)
+    if not success:
+        return fields
+    if request.args.get("stream") == "true":
+        #streams the whole feed instead of a page
+        if fields is not None:
+            query, serialize = project(Job, fields), lambda row: project_row(row, fields)
+        else:
+            query, serialize = Job.query.options(*Job.serialize_options()), lambda job: job.serialize()
+        success, query = filter_jobs_by(query)
+        if not success:
+            return query
+        return list_response("jobs", query.order_by(Job.date_created.desc(), Job.id.desc()), serialize)
+    if fields is not None:
+        #the cursor is built from id and date_created, so always select them
+        cursor_fields = [name for name in ("id", "date_created") if name not in fields]
+        success, query = filter_jobs_by(project(Job, fields + cursor_fields))
+        if not success:
+            return query
+        success, page = paginate_jobs(query)
+        if not success:
+            return page
+        rows, next_cursor = page
+        return success_response({"jobs": [project_row(row, fields) for row in rows], "next_cursor": next_cursor})
+
+    success, query = filter_jobs_by(Job.query.options(*Job.serialize_options()))
+    if not success:
+        return query
+    success, page = paginate_jobs(query)
+    if not success:
+        return page
+    jobs, next_cursor = page
+    return success_response({"jobs": [job.serialize() for job in jobs], "next_cursor": next_cursor})
 
 @app.route("/api/user/<int:user_id>/job/", methods=["POST"])
 def create_job(user_id):
@@ -303,11 +695,61 @@ def create_job(user_id):
         asset = None
     if title is None or description is None or  location is None or  date_activity is None or duration is None or reward is None or category is None or longtitude is None or latitude is None or relevant_skills is None:
         return failure_response("Missing one of the required fields", 400)
+    success, coordinates = jobs_dao.validate_coordinates(latitude, longtitude)
+    if not success:
+        return failure_response(coordinates, 400)
+    latitude, longtitude = coordinates
     job = Job(title = title, description = description, location = location, date_activity =date_activity, duration=duration, reward=reward, poster = user, category = category, longtitude = longtitude, latitude = latitude, asset=asset, relevant_skills=relevant_skills, other_notes=other_notes)
     db.session.add(job)
     db.session.commit()
     return success_response(job.serialize(), 201)
 
+@app.route("/api/user/<int:user_id>/job/bulk/", methods=["POST"])
+def create_jobs(user_id):
+    """
+    Endpoint for creating many jobs at once, from a json list of jobs or from
+    newline delimited json (Content-Type: application/x-ndjson)
+    """
+    user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return failure_response("User not found!")
+
+    if "ndjson" in (request.content_type or ""):
+        bodies = (line for line in request.stream if line.strip())
+    else:
+        try:
+            bodies = json.loads(request.data)
+        except ValueError:
+            return failure_response("Invalid json", 400)
+        if not isinstance(bodies, list):
+            return failure_response("Expected a list of jobs", 400)
+
+    results = []
+    rows = []
+    for index, body in enumerate(bodies):
+        if index >= jobs_dao.MAX_BULK_JOBS:
+            return failure_response(f"At most {jobs_dao.MAX_BULK_JOBS} jobs can be created at once", 413)
+        if isinstance(body, bytes):
+            try:
+                body = json.loads(body)
+            except ValueError:
+                results.append({"index": index, "error": "Invalid json"})
+                continue
+        success, row = jobs_dao.validate_job(body)
+        if not success:
+            results.append({"index": index, "error": row})
+            continue
+        results.append({"index": index})
+        rows.append(row)
+
+    if not rows:
+        return success_response({"created": 0, "failed": len(results), "results": results}, 400)
+    ids = iter(jobs_dao.create_jobs(user, rows))
+    for result in results:
+        if "error" not in result:
+            result["id"] = next(ids)
+    return success_response({"created": len(rows), "failed": len(results) - len(rows), "results": results}, 201)
+
 @app.route("/api/user/<int:user_id>/job/<int:job_id>/", methods= ["POST"])
 def add_job(user_id, job_id):
     """
@@ -327,6 +769,9 @@ def add_job(user_id, job_id):
     if user in job.poster:
         return failure_response("You cannot add your own job")
 
+    if job.status != "open":
+        return failure_response("This job is not open", 400)
+
     job.potential += [user]
     db.session.commit()
     return success_response(user.serialize(), 201)
@@ -350,9 +795,11 @@ def pick_receiver(job_id, user_id):
     if job not in user.job_as_potential:
         return failure_response("errorrrrrr")
 
+    if not job.set_status("taken"):
+        return failure_response("This job is not open", 400)
+
     user.job_as_potential.remove(job)
     job.receiver = [user]
-    job.taken = True
     db.session.commit()
 
     send_email(to=user.email, subject=f"Congrats! You were chosen for {job.title}", content=f"You were chosen to comeplete {job.title}. The date of the quest is {job.date_activity} and should last {job.duration} minutes. For more information, check your Jobs section in your profile!")
@@ -367,13 +814,27 @@ def complete_job(job_id):
     job = Job.query.filter_by(id = job_id).first()
     if job is None:
         return failure_response("Job not found!")
-    job.done = True
+    if not job.set_status("done"):
+        return failure_response("Only a taken job can be completed", 400)
     db.session.commit()
     send_email( to=job.poster[0].email, subject=f"The side quest {job.title} has been complete", content=f"You side quest has been completed. Please reach out to {job.receiver[0].first}!")
 
     return success_response(job.serialize(), 201)
 
 
+@app.route("/api/job/<int:job_id>/cancel/", methods= ["POST"])
+def cancel_job(job_id):
+    """
+    Endpoint for cancelling an open or taken job
+    """
+    job = Job.query.filter_by(id = job_id).first()
+    if job is None:
+        return failure_response("Job not found!")
+    if not job.set_status("cancelled"):
+        return failure_response("Only an open or taken job can be cancelled", 400)
+    db.session.commit()
+    return success_response(job.serialize(), 201)
+
 @app.route("/api/job/<int:job_id>/", methods = ["POST"])
 def update_job(job_id):
     """
@@ -396,6 +857,10 @@ def update_job(job_id):
     category = body.get("category")
     if title is None or description is None or  location is None or  date_activity is None or duration is None or reward is None or longtitude is None or latitude is None or relevant_skills is None or category is None:
         return failure_response("Missing one of the required fields", 400)
+    success, coordinates = jobs_dao.validate_coordinates(latitude, longtitude)
+    if not success:
+        return failure_response(coordinates, 400)
+    latitude, longtitude = coordinates
     job.title = title 
     job.description = description 
     job.location = location 
@@ -411,11 +876,20 @@ def update_job(job_id):
     return success_response(job.serialize(), 201)
 
 @app.route("/api/job/<int:job_id>/")
+@cache.cached("job", "user_profile", "asset", "asset_variant")
 def get_job(job_id):
     """
     Endpoint for getting a job by id
     """
-    job = Job.query.filter_by(id = job_id).first()
+    success, fields = extract_fields(Job)
+    if not success:
+        return fields
+    if fields is not None:
+        row = project(Job, fields).filter(Job.id == job_id).first()
+        if row is None:
+            return failure_response("Job not found!")
+        return success_response(project_row(row, fields))
+    job = Job.query.options(*Job.serialize_options()).filter_by(id = job_id).first()
     if job is None:
         return failure_response("Job not found!")
     return success_response(job.serialize())
@@ -435,12 +909,17 @@ def delete_job(job_id):
 #-----------------RATINGS--------------------------------------------
 
 @app.route("/api/rating/")
+@cache.cached("rating", "user_profile")
 def get_ratings():
     """
     Endpoint for getting all ratings
     """
-    ratings = [rating.serialize() for rating in Rating.query.all()]
-    return success_response({"ratings": ratings})
+    success, fields = extract_fields(Rating)
+    if not success:
+        return fields
+    if fields is not None:
+        return list_response("ratings", project(Rating, fields), lambda row: project_row(row, fields))
+    return list_response("ratings", Rating.query.options(*Rating.serialize_options()), lambda rating: rating.serialize())
 
 @app.route("/api/user/<int:user_id>/rating/<int:user2_id>/", methods=["POST"])
 def create_rating(user_id, user2_id):
@@ -452,6 +931,9 @@ def create_rating(user_id, user2_id):
     description = body.get("description")
     if rate is None or description is None:
         return failure_response("Missing one of the required fields", 400)
+    success, rate = parse_rate(rate)
+    if not success:
+        return failure_response("Rate must be a whole number from 1 to 5", 400)
 
     user = User.query.filter_by(id = user_id).first()
     if user is None:
@@ -463,6 +945,7 @@ def create_rating(user_id, user2_id):
 
     rating = Rating(rate = rate, description = description, poster = user, postee = user2)
     db.session.add(rating)
+    User.adjust_rating_totals(user2.id, rate, 1)
     db.session.commit()
     return success_response(rating.serialize(), 201)
 
@@ -487,8 +970,20 @@ def update_rating(user_id, rating_id):
     description = body.get("description")
     if rate is None or description is None:
         return failure_response("Missing one of the required fields", 400)
-    rating.rate = rate 
-    rating.description = description 
+    success, rate = parse_rate(rate)
+    if not success:
+        return failure_response("Rate must be a whole number from 1 to 5", 400)
+    #Swaps the rate only if it is still the one that was read, so concurrent
+    #updates cannot both take the same old rate off the totals of the postee
+    old_rate = rating.rate
+    while not Rating.query.filter_by(id = rating.id, rate = old_rate).update({Rating.rate: rate, Rating.description: description}, synchronize_session = False):
+        old_rate = db.session.query(Rating.rate).filter_by(id = rating.id).scalar()
+        if old_rate is None:
+            db.session.rollback()
+            return failure_response("Rating not found!")
+    for postee in rating.postee:
+        User.adjust_rating_totals(postee.id, old_rate, -1)
+        User.adjust_rating_totals(postee.id, rate, 1)
     db.session.commit()
     return success_response(rating.serialize(), 201)
 
@@ -497,7 +992,15 @@ def get_rating(rating_id):
     """
     Endpoint for getting a rating by id
     """
-    rating = Rating.query.filter_by(id = rating_id).first()
+    success, fields = extract_fields(Rating)
+    if not success:
+        return fields
+    if fields is not None:
+        row = project(Rating, fields).filter(Rating.id == rating_id).first()
+        if row is None:
+            return failure_response("Rating not found!")
+        return success_response(project_row(row, fields))
+    rating = Rating.query.options(*Rating.serialize_options()).filter_by(id = rating_id).first()
     if rating is None:
         return failure_response("Rating not found!")
     return success_response(rating.serialize())
@@ -507,9 +1010,11 @@ def delete_rating(rating_id):
     """
     Endpoint for deleting a rating by id
     """
-    rating = Rating.query.filter_by(id = rating_id).first()
+    rating = Rating.query.filter_by(id = rating_id).with_for_update().first()
     if rating is None:
         return failure_response("Rating not found!")
+    for postee in rating.postee:
+        User.adjust_rating_totals(postee.id, rating.rate, -1)
     db.session.delete(rating)
     db.session.commit()
     return success_response(rating.serialize())
@@ -523,7 +1028,16 @@ def get_chats(user_id):
     if user is None:
         return failure_response("User not found!")
 
-    new = [chat.serialize() for chat in user.chats]
+    success, fields = extract_fields(Chat)
+    if not success:
+        return fields
+    if fields is not None:
+        rows = project(Chat, fields).filter(Chat.users.any(User.id == user_id)).all()
+        return success_response({"chat": [project_row(row, fields) for row in rows]})
+
+    chats = Chat.query.options(*Chat.serialize_options()).filter(Chat.users.any(User.id == user_id)).all()
+    recent = chats_dao.get_recent_messages([chat.id for chat in chats], history_size(request.args.get("messages")))
+    new = [chat.serialize(messages=recent[chat.id]) for chat in chats]
     return success_response({"chat":new})
 
 @socketio.on('new_chat', namespace="/api/chat/")
@@ -531,6 +1045,8 @@ def create_chat(info):
     """
     Creates a new chat between users
     """
+    if info['sender_id'] == info['receiver_id']:
+        return failure_response("Cannot create a chat with yourself", 400)
     sender = User.query.filter_by(id=info['sender_id']).first()
     if sender is None:
         return failure_response("Sender not found")
@@ -540,39 +1056,21 @@ def create_chat(info):
     chat = Chat(users=[sender,receiver])
     db.session.add(chat)
     db.session.commit()
-    emit('chat_created', chat.serialize(), json=True)
+    emit('chat_created', chat.serialize(messages=[]), json=True)
 
 @socketio.on('private_message', namespace="/api/chat/")
 def handleMessage(info):
     """
     Handles socketio messaging
     """
-    sender = User.query.filter_by(id = info['sender_id']).first()
-    receiver = User.query.filter_by(id = info['receiver_id']).first()
-    sender_chats = sender.chats
-    receiver_chats = receiver.chats
-
-    sender_chat_ids = []
-    receiver_chat_ids = []
-
-    for x in sender_chats:
-        sender_chat_ids.append(x.id)
-    for x in receiver_chats:
-        receiver_chat_ids.append(x.id)
-
-    intersection = [value for value in sender_chat_ids if value in receiver_chat_ids]
-    room = intersection[0]
-    message = Message(sender_id = info['sender_id'], chat = room, message = info['msg'])
-    
-    chat = Chat.query.filter_by(id = room).first()
-    if chat is None:
+    room = chats_dao.get_chat_id_between(info['sender_id'], info['receiver_id'])
+    if room is None:
         emit('failure', 'chat not found')
-    time = datetime.datetime.now()
-    chat.time = time
-    db.session.add(message)
-    db.session.commit()
-    emit('private_message', message.serialize(), json=True, to = str(room))
-    return success_response(message.serialize())
+        return failure_response("Chat not found!")
+    message = message_buffer.save_message(info['sender_id'], room, info['msg'])
+    presence.set_typing(room, info['sender_id'], False)
+    emit('private_message', message, json=True, to = str(room))
+    return success_response(message)
 
 @socketio.on('join', namespace="/api/chat/")
 def get_chat(info):
@@ -585,31 +1083,94 @@ def get_chat(info):
     user2 = User.query.filter_by(id = info['user2_id']).first()
     if user2 is None: 
         return failure_response("User 2 not found", 400)
-    user1_chats = user1.chats
-    user2_chats = user2.chats
-
-    user1_chat_ids = []
-    user2_chat_ids = []
-    for x in user1_chats:
-        user1_chat_ids.append(x.id)
-    for x in user2_chats:
-        user2_chat_ids.append(x.id)
-    
-    intersection = [value for value in user1_chat_ids if value in user2_chat_ids]
-    room = intersection[0]
+    room = chats_dao.get_chat_id_between(user1.id, user2.id)
+    if room is None:
+        return failure_response("Chat not found!")
 
-    messages = Chat.query.filter_by(id=room).first().messages
-    new = [message.serialize() for message in messages.messages]
+    messages, has_more = chats_dao.get_messages(room, history_size(info.get('limit')), since=info.get('since'))
+    new = [message.serialize() for message in messages]
     #connect
     join_room(str(room))
-    emit('past_history' ,{'chat': new}, json=True, to=str(room))
+    emit('past_history', {'chat_id': room, 'chat': new, 'has_more': has_more}, json=True)
+    return success_response({'chat':new})
+
+@socketio.on('load_older', namespace="/api/chat/")
+def load_older(info):
+    """
+    Handles socketio for getting the messages of a chat older than a message,
+    or its newest messages if no message is given
+    """
+    chat = Chat.query.filter_by(id = info['chat_id']).first()
+    if chat is None:
+        emit('failure', 'chat not found')
+        return failure_response("Chat not found!")
+    messages, has_more = chats_dao.get_messages(chat.id, history_size(info.get('limit')), before=info.get('before'))
+    new = [message.serialize() for message in messages]
+    emit('older_history', {'chat_id': chat.id, 'chat': new, 'has_more': has_more}, json=True)
     return success_response({'chat':new})
 
 @socketio.on('connect', namespace="/api/chat/")
-def connect():
+def connect(auth=None):
+    """
+    Handles socketio connections. Clients that send their session token, as
+    {"session_token": ...} auth data or in the Authorization header, are
+    tracked as online
+    """
+    session_token = (auth or {}).get("session_token")
+    if session_token is None:
+        success, token = extract_token(request)
+        session_token = token if success else None
+    user_id = users_dao.get_user_id_by_session_token(session_token) if session_token else None
+    if user_id is not None:
+        presence.connected(request.sid, user_id)
     print("user connected")
     emit("connection_succeeded", "connected!")
 
+@socketio.on('disconnect', namespace="/api/chat/")
+def disconnect():
+    """
+    Handles socketio disconnections
+    """
+    presence.disconnected(request.sid)
+
+@socketio.on('typing', namespace="/api/chat/")
+def set_typing(info):
+    """
+    Handles socketio typing indicators of the connected user
+    """
+    user_id = presence.user_of(request.sid)
+    if user_id is None:
+        emit('failure', 'not signed in')
+        return failure_response("Not signed in", 400)
+    chat_id = info.get('chat_id')
+    if not isinstance(chat_id, int) or isinstance(chat_id, bool):
+        emit('failure', 'missing chat id')
+        return failure_response("Missing chat id", 400)
+    if not chats_dao.is_member(chat_id, user_id):
+        emit('failure', 'chat not found')
+        return failure_response("Chat not found!")
+    presence.set_typing(chat_id, user_id, bool(info.get('typing', True)))
+    return success_response({})
+
+@socketio.on('presence', namespace="/api/chat/")
+def get_presence(info):
+    """
+    Handles socketio for getting whether users are online and when they were
+    last seen. Only the connected user and the users they share a chat with are reported
+    """
+    user_id = presence.user_of(request.sid)
+    if user_id is None:
+        emit('failure', 'not signed in')
+        return failure_response("Not signed in", 400)
+    user_ids = info.get('user_ids')
+    if not isinstance(user_ids, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in user_ids):
+        emit('failure', 'user ids must be a list of ids')
+        return failure_response("user_ids must be a list of ids", 400)
+    visible = chats_dao.get_chat_partners(user_id, user_ids) | {user_id}
+    users = presence.get_presence([id for id in user_ids if id in visible])
+    emit('presence_state', users, json=True)
+    return success_response(users)
+
 @app.route("/api/chat/<int:chat_id>/", methods=["DELETE"])
 def delete_chat(chat_id):
     """
@@ -633,5 +1194,40 @@ def delete_message(message_id):
     db.session.delete(message)
     db.session.commit()
     return success_response(message.serialize())
+
+@app.cli.command("rebuild-ratings")
+@click.option("--check", is_flag=True, help="Only report users whose totals are wrong")
+def rebuild_ratings(check):
+    """
+    Command for recomputing every user's rating totals from their ratings
+    """
+    wrong = users_dao.rebuild_rating_totals(check_only = check)
+    if not wrong:
+        print("All rating totals are consistent")
+        return
+    print(f"{'Found' if check else 'Fixed'} wrong rating totals for users: {', '.join(map(str, wrong))}")
+    if check:
+        sys.exit(1)
+
+@app.cli.command("expire-jobs")
+@click.option("--days", default=30, show_default=True, help="Age in days after which open jobs expire")
+def expire_jobs(days):
+    """
+    Command for marking the open jobs older than some days as expired
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    count = Job.query.filter(Job.status == "open", Job.date_created < cutoff).update({Job.status: "expired"}, synchronize_session=False)
+    db.session.commit()
+    print(f"Expired {count} jobs")
+
+#-----------------METRICS--------------------------------------------
+
+@app.route("/api/metrics/passwords/")
+def get_password_metrics():
+    """
+    Endpoint for getting the queue depth and latency of the password hashing pool
+    """
+    return success_response(passwords.metrics())
+
 if __name__ == "__main__":
     socketio.run(app, host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
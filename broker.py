@@ -0,0 +1,165 @@
+"""
+Broker file
+
+A small pub/sub message broker that lets the chat websocket run on several
+processes without Redis, and the Socket.IO client manager that talks to it.
+The broker relays every message it receives to every subscribed connection.
+Start it with "python broker.py [host:port]" and point each app process at it
+with SOCKETIO_MESSAGE_QUEUE=broker://host:port
+"""
+
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+
+DEFAULT_PORT = 5555
+RECONNECT_SECONDS = 1
+SUBSCRIBE = b"subscribe\n"
+
+
+class BrokerManager(socketio.PubSubManager):
+    """
+    Socket.IO client manager that shares rooms and emits between processes
+    through the broker
+    """
+    name = "broker"
+
+    def __init__(self, url, channel="flask-socketio", write_only=False, logger=None):
+        """
+        Creates a manager for the broker at a broker://host:port url
+        """
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or DEFAULT_PORT)
+        self.publisher = None
+        self.publisher_lock = threading.Lock()
+
+    def initialize(self):
+        """
+        Starts listening to the broker. Like the Redis manager, this needs a
+        monkey patched socket library under eventlet or gevent, which is checked
+        before the listener thread is started
+        """
+        monkey_patched = True
+        if self.server.async_mode == "eventlet":
+            from eventlet.patcher import is_monkey_patched
+            monkey_patched = is_monkey_patched("socket")
+        elif "gevent" in self.server.async_mode:
+            from gevent.monkey import is_module_patched
+            monkey_patched = is_module_patched("socket")
+        if not monkey_patched:
+            raise RuntimeError(f"The message broker requires a monkey patched socket library to work with {self.server.async_mode}")
+        super().initialize()
+
+    def _publish(self, data):
+        """
+        Sends a message to the broker, reconnecting once if the connection dropped
+        """
+        line = (json.dumps({"channel": self.channel, "data": data}) + "\n").encode("utf8")
+        with self.publisher_lock:
+            for _ in range(2):
+                try:
+                    if self.publisher is None:
+                        self.publisher = socket.create_connection(self.address)
+                    self.publisher.sendall(line)
+                    return
+                except OSError:
+                    if self.publisher is not None:
+                        self.publisher.close()
+                    self.publisher = None
+        self._get_logger().error("Cannot publish to the message broker")
+
+    def _listen(self):
+        """
+        Yields the messages other processes publish on this channel, reconnecting
+        to the broker whenever the connection drops
+        """
+        while True:
+            try:
+                with socket.create_connection(self.address) as connection:
+                    connection.sendall(SUBSCRIBE)
+                    for line in connection.makefile("rb"):
+                        message = json.loads(line)
+                        if message["channel"] == self.channel:
+                            yield message["data"]
+            except OSError:
+                self._get_logger().error("Lost the connection to the message broker, reconnecting")
+            time.sleep(RECONNECT_SECONDS)
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one connection to the broker. A connection that sends SUBSCRIBE
+    receives every message published from then on, any other line it sends
+    is published
+    """
+
+    def handle(self):
+        """
+        Reads lines until the connection closes
+        """
+        try:
+            for line in self.rfile:
+                if line == SUBSCRIBE:
+                    self.server.subscribe(self.wfile)
+                else:
+                    self.server.publish(line)
+        except OSError:
+            pass
+        finally:
+            self.server.unsubscribe(self.wfile)
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    """
+    TCP server relaying published lines to its subscribers
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        """
+        Binds the broker to a (host, port) address
+        """
+        super().__init__(address, BrokerHandler)
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, wfile):
+        """
+        Starts relaying messages to a connection
+        """
+        with self.lock:
+            self.subscribers.add(wfile)
+
+    def unsubscribe(self, wfile):
+        """
+        Stops relaying messages to a connection
+        """
+        with self.lock:
+            self.subscribers.discard(wfile)
+
+    def publish(self, line):
+        """
+        Relays a line to every subscriber, dropping the ones that went away
+        """
+        with self.lock:
+            for wfile in list(self.subscribers):
+                try:
+                    wfile.write(line)
+                    wfile.flush()
+                except OSError:
+                    self.subscribers.discard(wfile)
+
+
+if __name__ == "__main__":
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else "").rpartition(":")
+    broker = Broker((host or "0.0.0.0", int(port or DEFAULT_PORT)))
+    print(f"Message broker listening on {broker.server_address[0]}:{broker.server_address[1]}")
+    broker.serve_forever()
@@ -0,0 +1,90 @@
+"""
+Cache file
+
+Caches the responses of read-heavy GET endpoints in memory, keyed by path and
+query parameters, and tags them with an ETag built from the versions of the
+tables they read (see CacheVersion). Any committed write to one of those
+tables changes the ETag, so cached responses are never served once they are
+out of date, and a client sending a current ETag in If-None-Match gets an
+empty 304. Responses that only show the profile of users track user_profile
+instead of user, so last seen times and session tokens don't change them
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from os import environ
+
+from flask import make_response, request
+from sqlalchemy.exc import IntegrityError
+
+from db import db, CacheVersion
+
+RESPONSE_CACHE_SIZE = int(environ.get("RESPONSE_CACHE_SIZE", 1000))
+
+# Maps (path, query parameters) to (table versions, body), least recently used first
+_responses = OrderedDict()
+_lock = threading.Lock()
+
+
+def init_versions():
+    """
+    Creates the version counters of the tables, and of the parts of tables
+    (see CacheVersion.PARTS), that don't have one yet
+
+    Must be called inside an app context
+    """
+    existing = {row.name for row in db.session.query(CacheVersion.name).all()}
+    for name in set(db.Model.metadata.tables).union(CacheVersion.PARTS) - existing:
+        db.session.add(CacheVersion(name = name, version = 0))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+
+def cached(*tables):
+    """
+    Decorator for GET endpoints whose responses only depend on their path,
+    their query parameters and the given tables. Only successful (body, code)
+    responses are cached, streamed ones are passed through
+    """
+    CacheVersion.tracked.update(tables)
+
+    def decorator(endpoint):
+        @wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            versions = CacheVersion.current(tables)
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            etag = hashlib.sha1(repr((key, versions)).encode("utf8")).hexdigest()
+            if request.if_none_match.contains(etag):
+                return _tagged(make_response("", 304), etag)
+
+            with _lock:
+                entry = _responses.get(key)
+                if entry is not None and entry[0] == versions:
+                    _responses.move_to_end(key)
+                    return _tagged(make_response(entry[1], 200), etag)
+
+            response = endpoint(*args, **kwargs)
+            if not isinstance(response, tuple) or response[1] != 200:
+                return response
+            body, code = response
+            with _lock:
+                _responses[key] = (versions, body)
+                _responses.move_to_end(key)
+                while len(_responses) > RESPONSE_CACHE_SIZE:
+                    _responses.popitem(last=False)
+            return _tagged(make_response(body, code), etag)
+        return wrapper
+    return decorator
+
+
+def _tagged(response, etag):
+    """
+    Sets the ETag of a response and asks clients to revalidate it on every use
+    """
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
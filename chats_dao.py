@@ -0,0 +1,82 @@
+"""
+DAO (Data Access Object) file for chats
+
+Helper file containing functions for accessing chats in our database
+"""
+
+from db import db, Chat, Message, association_table_chat
+
+
+def get_chat_id_between(user1_id, user2_id):
+    """
+    Returns the id of the oldest chat between two users, or None if they have
+    no chat
+    """
+    user_low, user_high = Chat.pair_key(user1_id, user2_id)
+    row = Chat.query.with_entities(Chat.id).filter(
+        Chat.user_low == user_low, Chat.user_high == user_high
+    ).order_by(Chat.id).first()
+    return None if row is None else row.id
+
+
+def is_member(chat_id, user_id):
+    """
+    Returns true if a user is one of the users of a chat
+    """
+    return db.session.query(association_table_chat.c.chat_id).filter(
+        association_table_chat.c.chat_id == chat_id,
+        association_table_chat.c.user_id == user_id
+    ).first() is not None
+
+
+def get_chat_partners(user_id, user_ids):
+    """
+    Returns the ids among user_ids of the users that share a chat with a user
+    """
+    mine = association_table_chat.alias()
+    theirs = association_table_chat.alias()
+    rows = db.session.query(theirs.c.user_id).join(mine, mine.c.chat_id == theirs.c.chat_id).filter(
+        mine.c.user_id == user_id,
+        theirs.c.user_id.in_(user_ids)
+    ).distinct().all()
+    return {row.user_id for row in rows}
+
+
+def get_messages(chat_id, limit, before=None, since=None):
+    """
+    Returns a page of at most limit messages of a chat, oldest first, and
+    whether there are more messages past the page
+
+    With before (a message id) the page holds the newest messages older than
+    it, so there may be more older ones. With since (a message id) it holds the
+    oldest messages newer than it, so there may be more newer ones. With
+    neither it holds the newest messages of the chat
+    """
+    query = Message.query.filter(Message.chat_id == chat_id)
+    if since is not None:
+        messages = query.filter(Message.id > since).order_by(Message.id).limit(limit + 1).all()
+        return messages[:limit], len(messages) > limit
+
+    if before is not None:
+        query = query.filter(Message.id < before)
+    messages = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    return messages[:limit][::-1], len(messages) > limit
+
+
+def get_recent_messages(chat_ids, limit):
+    """
+    Returns the newest limit messages of each chat in one query, as a dict
+    from chat id to its messages, oldest first
+    """
+    ranked = db.session.query(
+        Message.id.label("id"),
+        db.func.row_number().over(partition_by=Message.chat_id, order_by=Message.id.desc()).label("rank")
+    ).filter(Message.chat_id.in_(chat_ids)).subquery()
+    messages = Message.query.join(ranked, Message.id == ranked.c.id).filter(
+        ranked.c.rank <= limit
+    ).order_by(Message.chat_id, Message.id).all()
+
+    recent = {chat_id: [] for chat_id in chat_ids}
+    for message in messages:
+        recent[message.chat_id].append(message)
+    return recent
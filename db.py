@@ -1,55 +1,87 @@
 import datetime
 import hashlib
 import os
+import sqlite3
 from os import environ
 
-import bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, selectinload
 import base64
-import boto3
 import io
 from io import BytesIO
 from mimetypes import guess_type, guess_extension
 from PIL import Image
-import random
 import re
-import string
+from uuid import uuid4
+
+import passwords
+import storage
 
 db = SQLAlchemy()
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Puts SQLite connections in WAL mode, so readers don't block the writer and
+    commits don't wait on a full fsync, and makes writers wait for the lock
+    instead of failing right away
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
 #-----------------TABLES-------------------------------------------
+#Each association table is keyed by both of its columns, which also indexes
+#lookups by the first one; the second one has its own index
 association_table_poster = db.Table("association_poster", db.Model.metadata,
-    db.Column("job_id", db.Integer, db.ForeignKey("job.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("job_id", db.Integer, db.ForeignKey("job.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_association_poster_user_id", "user_id")
 )
 
 association_table_receiver = db.Table("association_receiver", db.Model.metadata,
-    db.Column("job_id", db.Integer, db.ForeignKey("job.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("job_id", db.Integer, db.ForeignKey("job.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_association_receiver_user_id", "user_id")
 )
 
 association_table_potential = db.Table("association_potential", db.Model.metadata,
-    db.Column("job_id", db.Integer, db.ForeignKey("job.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("job_id", db.Integer, db.ForeignKey("job.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_association_potential_user_id", "user_id")
 )
 
 association_table_rating_poster = db.Table("association_rating_poster", db.Model.metadata,
-    db.Column("rating_id", db.Integer, db.ForeignKey("rating.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("rating_id", db.Integer, db.ForeignKey("rating.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_association_rating_poster_user_id", "user_id")
 )
 
 association_table_rating_postee = db.Table("association_rating_postee", db.Model.metadata,
-    db.Column("rating_id", db.Integer, db.ForeignKey("rating.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("rating_id", db.Integer, db.ForeignKey("rating.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_association_rating_postee_user_id", "user_id")
 )
 
 association_table_chat = db.Table("association_chat", db.Model.metadata,
-    db.Column("chat_id", db.Integer, db.ForeignKey("chat.id")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("chat_id", db.Integer, db.ForeignKey("chat.id"), primary_key=True),
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_association_chat_user_id", "user_id")
 )
 
 
 #-----------------USERS--------------------------------------------
+#Star values a rating can have
+RATES = range(1, 6)
+
 class User(db.Model):
     """
     User model
@@ -65,7 +97,7 @@ class User(db.Model):
     first = db.Column(db.String, nullable = False)
     last = db.Column(db.String, nullable = False)
     email = db.Column(db.String, nullable = False)
-    phone_number = db.Column(db.Integer, nullable = False)
+    phone_number = db.Column(db.BigInteger, nullable = False)
     images = db.relationship("Asset", cascade="delete")
     messages = db.relationship("Message", cascade="delete")
 
@@ -78,6 +110,17 @@ class User(db.Model):
     
     #Chat info
     chats = db.relationship("Chat", secondary=association_table_chat, back_populates='users')
+    #Written in batches by presence.py, so it can lag behind by a few seconds
+    last_seen = db.Column(db.DateTime, nullable = True)
+
+    #Totals of the ratings received, kept up to date by adjust_rating_totals
+    rating_count = db.Column(db.Integer, nullable = False, default = 0)
+    rating_sum = db.Column(db.Integer, nullable = False, default = 0)
+    rating_1 = db.Column(db.Integer, nullable = False, default = 0)
+    rating_2 = db.Column(db.Integer, nullable = False, default = 0)
+    rating_3 = db.Column(db.Integer, nullable = False, default = 0)
+    rating_4 = db.Column(db.Integer, nullable = False, default = 0)
+    rating_5 = db.Column(db.Integer, nullable = False, default = 0)
 
     # Session information
     session_token = db.Column(db.String, nullable=False, unique=True)
@@ -88,11 +131,15 @@ class User(db.Model):
         """
         Initializes a User object
         """
-        self.password_digest = bcrypt.hashpw(kwargs.get("password").encode("utf8"), bcrypt.gensalt(rounds=13))
+        self.password_digest = passwords.hash_password(kwargs.get("password"))
         self.first = kwargs.get("first")
         self.last = kwargs.get("last")
         self.email = kwargs.get("email")
         self.phone_number = kwargs.get("phone_number")
+        self.rating_count = 0
+        self.rating_sum = 0
+        for rate in RATES:
+            setattr(self, f"rating_{rate}", 0)
         self.renew_session()
 
     def serialize(self):
@@ -113,9 +160,70 @@ class User(db.Model):
             "rating_as_postee":  [r.simple_serialize() for r in self.rating_as_postee],
             "chats": [c.simple_serialize() for c in self.chats],
             "messages": [m.serialize() for m in self.messages],
+            "rating": self.rating_summary(),
+            "last_seen": self.last_seen,
             "token": self.session_token
         }
 
+    def rating_summary(self):
+        """
+        Serializes the totals of the ratings a user received
+        """
+        return {
+            "count": self.rating_count,
+            "average": self.rating_sum / self.rating_count if self.rating_count else None,
+            "histogram": {str(rate): getattr(self, f"rating_{rate}") for rate in RATES}
+        }
+
+    @staticmethod
+    def adjust_rating_totals(user_id, rate, delta):
+        """
+        Adds (delta 1) or removes (delta -1) a rating from the totals of a user,
+        in one UPDATE so concurrent ratings cannot overwrite each other
+        """
+        totals = {
+            User.rating_count: User.rating_count + delta,
+            User.rating_sum: User.rating_sum + delta * rate
+        }
+        if rate in RATES:
+            column = getattr(User, f"rating_{rate}")
+            totals[column] = column + delta
+        User.query.filter_by(id = user_id).update(totals)
+
+    SIMPLE_FIELDS = ("id", "first", "last", "email")
+
+    @staticmethod
+    def projection():
+        """
+        Returns the columns of a User that can be selected directly by name
+        """
+        return {
+            "id": User.id,
+            "first": User.first,
+            "last": User.last,
+            "email": User.email,
+            "phone_number": User.phone_number,
+            "rating_count": User.rating_count,
+            "rating_average": db.case((User.rating_count > 0, User.rating_sum * 1.0 / User.rating_count), else_ = None),
+            "last_seen": User.last_seen
+        }
+
+    @staticmethod
+    def serialize_options():
+        """
+        Returns the loader options for every relationship User.serialize touches
+        """
+        return [
+            selectinload(User.images).selectinload(Asset.variants),
+            selectinload(User.job_as_poster),
+            selectinload(User.job_as_receiver),
+            selectinload(User.job_as_potential),
+            selectinload(User.rating_as_poster),
+            selectinload(User.rating_as_postee),
+            selectinload(User.chats),
+            selectinload(User.messages)
+        ]
+
     def simple_serialize(self):
         """
         Serializes an Profile object without any other class
@@ -148,7 +256,7 @@ class User(db.Model):
         """
         Verifies the password of a user
         """
-        return bcrypt.checkpw(password.encode("utf8"), self.password_digest)
+        return passwords.check_password(password, self.password_digest)
 
     def verify_session_token(self, session_token):
         """
@@ -169,9 +277,6 @@ class User(db.Model):
 #-----------------IMAGES--------------------------------------------
 
 EXTENSIONS = ["png", "gif", "jpg", "jpeg"]
-BASE_DIR = os.getcwd()
-S3_BUCKET_NAME = environ.get("S3_BUCKET_NAME")
-S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-2.amazonaws.com"
 
 class Asset(db.Model):
     """
@@ -185,75 +290,97 @@ class Asset(db.Model):
     width = db.Column(db.Integer, nullable = False)
     height = db.Column(db.Integer, nullable = False)
     created_at = db.Column(db.DateTime, nullable = False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable = True)
-    job_id = db.Column(db.Integer, db.ForeignKey("job.id"), nullable = True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable = True, index = True)
+    job_id = db.Column(db.Integer, db.ForeignKey("job.id"), nullable = True, index = True)
+    content_hash = db.Column(db.String, nullable = True, index = True)
+    variants = db.relationship("AssetVariant", cascade="delete")
 
     def __init__(self, **kwargs):
         """
-        Initializes an asset object
+        Initializes an asset object, either from an image in base64 encoding
+        (image_data) or from the raw bytes of an image and their extension
+        (image_bytes and extension)
         """
-        self.create(kwargs.get("image_data"), kwargs.get("user_id", None), kwargs.get("job_id", None))
+        if kwargs.get("image_data") is not None:
+            self.create(kwargs.get("image_data"), kwargs.get("user_id", None), kwargs.get("job_id", None))
+        else:
+            self.store(kwargs.get("image_bytes"), kwargs.get("extension"), kwargs.get("user_id", None), kwargs.get("job_id", None))
     
     def create(self, image_data, user_id, job_id):
         """
         Given an image in base64 encoding, does the following
         1. Rejects the image if it is not a supported filetype
-        2. Generate a random string for the image filename
-        3. Decodes the image and attempts to upload to AWS
+        2. Decodes the image and stores it
         """ 
         try:
             ext = guess_extension(guess_type(image_data)[0])[1:]
             if ext not in EXTENSIONS:
                 raise Exception(f"Extension {ext} is not valid!")
             
-            salt = "".join( #random generator creates filename
-                random.SystemRandom().choice(
-                    string.ascii_uppercase + string.digits
-                )
-                for _ in range(16)
-            )
-            
             img_str = re.sub("^data:image/.+;base64,", "", image_data)
             img_data = base64.b64decode(img_str)
-            img = Image.open(BytesIO(img_data))
+            self.store(img_data, ext, user_id, job_id)
+        except Exception as e:
+            print(f"Error when creating image: {e}")
 
-            self.base_url = S3_BASE_URL
-            self.salt = salt
-            self.extension = ext
-            self.width = img.width
-            self.height = img.height
+    def store(self, img_data, ext, user_id, job_id):
+        """
+        Given the bytes of an image, does the following
+        1. Hashes the image, which becomes its filename
+        2. Reuses the stored image with the same hash if there is one
+        3. Otherwise reads the size of the image from its header and
+           attempts to upload the image to storage
+        """
+        try:
+            content_hash = hashlib.sha256(img_data).hexdigest()
+            stored = AssetObject.query.filter_by(content_hash = content_hash).first()
+            if stored is None:
+                img = Image.open(BytesIO(img_data))
+                stored = AssetObject.add_reference(content_hash = content_hash, base_url = storage.get_storage().base_url, extension = ext, width = img.width, height = img.height)
+                if stored.ref_count == 1:
+                    self.upload(img_data, f"{content_hash}.{ext}")
+            else:
+                AssetObject.query.filter_by(content_hash = content_hash).update({AssetObject.ref_count: AssetObject.ref_count + 1}, synchronize_session = False)
+
+            self.base_url = stored.base_url
+            self.salt = content_hash
+            self.content_hash = content_hash
+            self.extension = stored.extension
+            self.width = stored.width
+            self.height = stored.height
             self.created_at = datetime.datetime.now()
             if user_id is not None:
                 self.user_id = user_id
             if job_id is not None:
                 self.job_id = job_id
-            img_filename = f"{self.salt}.{self.extension}"
-            self.upload(img, img_filename)
+            #kept so the resized variants can be made without downloading the image again
+            self.img_data = img_data
         except Exception as e:
             print(f"Error when creating image: {e}")
     
-    def upload(self, img, img_filename):
+    def upload(self, img_data, img_filename):
         """
-        Attempts to upload the image into the specified S3 bucket
+        Attempts to upload the image bytes into storage as a publicly readable object
         """
         try:
-            #save image into temporary
-            img_temp_loc = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temp_loc)
-
-            #upload image into S3 bucket
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temp_loc, S3_BUCKET_NAME, img_filename)
-            
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, img_filename) 
-            object_acl.put(ACL = "public-read")
-
-            #remove img from temp location
-            os.remove(img_temp_loc)
+            storage.get_storage().put(img_filename, BytesIO(img_data), guess_type(img_filename)[0])
         except Exception as e:
             print(f"Error when uploading image: {e}")
         
+    def release(self, session):
+        """
+        Drops this asset's reference to its stored image, and schedules the image
+        and its variants for deletion from storage once no asset uses them
+        """
+        filenames = [f"{self.salt}.{self.extension}"] + [v.filename for v in self.variants]
+        if self.content_hash is not None:
+            stored = session.query(AssetObject).filter_by(content_hash = self.content_hash)
+            stored.update({AssetObject.ref_count: AssetObject.ref_count - 1}, synchronize_session = False)
+            if session.query(AssetObject.ref_count).filter_by(content_hash = self.content_hash).scalar() > 0:
+                return
+            stored.delete(synchronize_session = False)
+        session.info.setdefault("released_images", []).extend(filenames)
+
     def serialize(self):
         """
         Serializes an asset object
@@ -261,14 +388,157 @@ class Asset(db.Model):
         return {
             "id" : self.id,
             "url": f"{self.base_url}/{self.salt}.{self.extension}",
-            "created_at": str(self.created_at),
+            "created_at": self.created_at,
             "job_id": self.job_id,
-            "user_id": self.user_id
+            "user_id": self.user_id,
+            "variants": {v.name: v.serialize() for v in self.variants}
+        }
+
+    @staticmethod
+    def serialize_options():
+        """
+        Returns the loader options for every relationship Asset.serialize touches
+        """
+        return [selectinload(Asset.variants)]
+
+    SIMPLE_FIELDS = ("id", "url")
+
+    @staticmethod
+    def projection():
+        """
+        Returns the columns of an Asset that can be selected directly by name,
+        building the url in SQL
+        """
+        return {
+            "id": Asset.id,
+            "url": Asset.base_url + "/" + Asset.salt + "." + Asset.extension,
+            "created_at": Asset.created_at,
+            "width": Asset.width,
+            "height": Asset.height,
+            "job_id": Asset.job_id,
+            "user_id": Asset.user_id
+        }
+
+
+class AssetObject(db.Model):
+    """
+    AssetObject Model, an image in storage shared by every asset with the same content
+    """
+    __tablename__ = "asset_object"
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    content_hash = db.Column(db.String, nullable = False, unique = True)
+    base_url = db.Column(db.String, nullable = False)
+    extension = db.Column(db.String, nullable = False)
+    width = db.Column(db.Integer, nullable = False)
+    height = db.Column(db.Integer, nullable = False)
+    ref_count = db.Column(db.Integer, nullable = False)
+
+    def __init__(self, **kwargs):
+        """
+        Initializes an asset object entry, referenced by one asset
+        """
+        self.content_hash = kwargs.get("content_hash")
+        self.base_url = kwargs.get("base_url")
+        self.extension = kwargs.get("extension")
+        self.width = kwargs.get("width")
+        self.height = kwargs.get("height")
+        self.ref_count = 1
+
+    @staticmethod
+    def add_reference(**kwargs):
+        """
+        Inserts an asset object, or adds a reference to it if an upload of the
+        same content inserted it first, in one upsert. Returns its row, whose
+        ref_count is 1 only if it was just inserted
+        """
+        if db.engine.dialect.name not in ("sqlite", "postgresql"):
+            stored = AssetObject(**kwargs)
+            db.session.add(stored)
+            db.session.flush()
+            return stored
+        dialect_insert = sqlite_insert if db.engine.dialect.name == "sqlite" else postgresql_insert
+        upsert = dialect_insert(AssetObject.__table__).values(ref_count = 1, **kwargs).on_conflict_do_update(
+            index_elements = [AssetObject.content_hash],
+            set_ = {"ref_count": AssetObject.__table__.c.ref_count + 1}
+        )
+        db.session.execute(upsert)
+        return db.session.query(
+            AssetObject.base_url, AssetObject.extension, AssetObject.width, AssetObject.height, AssetObject.ref_count
+        ).filter_by(content_hash = kwargs["content_hash"]).one()
+
+@event.listens_for(Session, "before_flush")
+def release_deleted_assets(session, flush_context, instances):
+    """
+    Releases the stored images of the assets being deleted
+    """
+    for obj in list(session.deleted):
+        if isinstance(obj, Asset):
+            obj.release(session)
+
+@event.listens_for(Session, "after_commit")
+def delete_released_images(session):
+    """
+    Deletes the images released by a committed transaction from storage
+    """
+    for filename in session.info.pop("released_images", []):
+        try:
+            storage.get_storage().delete(filename)
+        except Exception as e:
+            print(f"Error when deleting image: {e}")
+
+@event.listens_for(Session, "after_rollback")
+def keep_released_images(session):
+    """
+    Forgets the images released by a rolled back transaction
+    """
+    session.info.pop("released_images", None)
+
+class AssetVariant(db.Model):
+    """
+    AssetVariant Model, a resized and recompressed copy of an asset
+    """
+    __tablename__ = "asset_variant"
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    asset_id = db.Column(db.Integer, db.ForeignKey("asset.id"), nullable = False, index = True)
+    name = db.Column(db.String, nullable = False)
+    base_url = db.Column(db.String, nullable = False)
+    filename = db.Column(db.String, nullable = False)
+    width = db.Column(db.Integer, nullable = False)
+    height = db.Column(db.Integer, nullable = False)
+
+    def __init__(self, **kwargs):
+        """
+        Initializes an asset variant object
+        """
+        self.asset_id = kwargs.get("asset_id")
+        self.name = kwargs.get("name")
+        self.base_url = kwargs.get("base_url")
+        self.filename = kwargs.get("filename")
+        self.width = kwargs.get("width")
+        self.height = kwargs.get("height")
+
+    def serialize(self):
+        """
+        Serializes an asset variant object
+        """
+        return {
+            "url": f"{self.base_url}/{self.filename}",
+            "width": self.width,
+            "height": self.height
         }
 
     
 #-----------------JOBS--------------------------------------------
 
+#Statuses a job can be in, and the statuses each one can move to
+JOB_TRANSITIONS = {
+    "open": ("taken", "cancelled", "expired"),
+    "taken": ("done", "cancelled"),
+    "done": (),
+    "cancelled": (),
+    "expired": ()
+}
+
 class Job(db.Model):
     """
     Job Model
@@ -284,8 +554,8 @@ class Job(db.Model):
     reward = db.Column(db.String, nullable = False)
     done = db.Column(db.Boolean, nullable = False)
     taken = db.Column(db.Boolean, nullable = False)
-    longtitude = db.Column(db.Integer, nullable = False)
-    latitude = db.Column(db.Integer, nullable = False)
+    longtitude = db.Column(db.Float, nullable = False)
+    latitude = db.Column(db.Float, nullable = False)
     poster = db.relationship("User", secondary=association_table_poster, back_populates='job_as_poster')
     receiver =  db.relationship("User", secondary=association_table_receiver, back_populates='job_as_receiver')
     images = db.relationship("Asset", cascade="delete")
@@ -293,6 +563,18 @@ class Job(db.Model):
     category = db.Column(db.String, nullable = False)
     other_notes = db.Column(db.String, nullable = True)
     relevant_skills = db.Column(db.String, nullable = False)
+    #One of JOB_TRANSITIONS, changed only through set_status. taken and done
+    #are kept in sync with it for older clients
+    status = db.Column(db.String, nullable = False, default = "open")
+
+    #Back the keyset pagination of the job feed: unfiltered, by status, and
+    #open jobs by category, which only indexes open jobs
+    __table_args__ = (
+        db.Index("ix_job_date_created_id", "date_created", "id"),
+        db.Index("ix_job_status_date_created_id", "status", "date_created", "id"),
+        db.Index("ix_job_open_category_date_created_id", "category", "date_created", "id",
+            sqlite_where = db.text("status = 'open'"), postgresql_where = db.text("status = 'open'"))
+    )
 
     def __init__(self, **kwargs):
         """
@@ -311,6 +593,7 @@ class Job(db.Model):
         self.latitude = kwargs.get("latitude")
         self.done = False
         self.taken = False
+        self.status = "open"
         self.relevant_skills = kwargs.get("relevant_skills")
         self.other_notes = kwargs.get("other_notes")
         if not kwargs.get("asset") is None:
@@ -325,12 +608,13 @@ class Job(db.Model):
             "title": self.title,
             "description": self.description,
             "location": self.location,
-            "date_created": str(self.date_created),
+            "date_created": self.date_created,
             "date_activity": self.date_activity,
             "duration": self.duration,
             "reward": self.reward,
             "done": self.done,
             "taken": self.taken,
+            "status": self.status,
             "category": self.category,
             "longtitude": self.longtitude,
             "latitude": self.latitude,
@@ -342,6 +626,56 @@ class Job(db.Model):
             "potential": [p.simple_serialize() for p in self.potential]
         }
 
+    def set_status(self, status):
+        """
+        Moves the job to a new status if JOB_TRANSITIONS allows it
+
+        Returns if the job could move to the status
+        """
+        if status not in JOB_TRANSITIONS.get(self.status, ()):
+            return False
+        self.status = status
+        self.taken = status in ("taken", "done")
+        self.done = status == "done"
+        return True
+
+    SIMPLE_FIELDS = ("id", "title", "reward", "done", "status")
+
+    @staticmethod
+    def projection():
+        """
+        Returns the columns of a Job that can be selected directly by name
+        """
+        return {
+            "id": Job.id,
+            "title": Job.title,
+            "description": Job.description,
+            "location": Job.location,
+            "date_created": Job.date_created,
+            "date_activity": Job.date_activity,
+            "duration": Job.duration,
+            "reward": Job.reward,
+            "done": Job.done,
+            "taken": Job.taken,
+            "status": Job.status,
+            "category": Job.category,
+            "longtitude": Job.longtitude,
+            "latitude": Job.latitude,
+            "relevant_skills": Job.relevant_skills,
+            "other_notes": Job.other_notes
+        }
+
+    @staticmethod
+    def serialize_options():
+        """
+        Returns the loader options for every relationship Job.serialize touches
+        """
+        return [
+            selectinload(Job.poster).selectinload(User.images).selectinload(Asset.variants),
+            selectinload(Job.receiver),
+            selectinload(Job.potential)
+        ]
+
     def simple_serialize(self):
         """
         Simple serializes a job object
@@ -351,6 +685,7 @@ class Job(db.Model):
             "title": self.title,
             "reward": self.reward,
             "done": self.done,
+            "status": self.status
         }
 
 #-----------------RATINGS--------------------------------------------
@@ -387,6 +722,29 @@ class Rating(db.Model):
             "poster": [p.simple_serialize() for p in self.poster],
             "postee": [p.simple_serialize() for p in self.postee],
         }
+
+    SIMPLE_FIELDS = ("id", "rate", "description")
+
+    @staticmethod
+    def projection():
+        """
+        Returns the columns of a Rating that can be selected directly by name
+        """
+        return {
+            "id": Rating.id,
+            "rate": Rating.rate,
+            "description": Rating.description
+        }
+
+    @staticmethod
+    def serialize_options():
+        """
+        Returns the loader options for every relationship Rating.serialize touches
+        """
+        return [
+            selectinload(Rating.poster),
+            selectinload(Rating.postee)
+        ]
     
     def simple_serialize(self):
         """
@@ -408,25 +766,66 @@ class Chat(db.Model):
     messages = db.relationship("Message", cascade="delete")
     users = db.relationship("User", secondary=association_table_chat, back_populates='chats')
     time = db.Column(db.String, nullable=False)
+    #The smaller and larger id of the two users in the chat, so the chat
+    #between two users is found with one indexed lookup
+    user_low = db.Column(db.Integer, nullable=True)
+    user_high = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (db.Index("ix_chat_user_low_user_high", "user_low", "user_high"),)
 
     def __init__(self, **kwargs):
         """
         Creates a Chat object
         """
         self.users = kwargs.get("users")
-        self.time = datetime.datetime.now()
+        self.time = str(datetime.datetime.now())
+        ids = [u.id for u in self.users]
+        self.user_low = min(ids)
+        self.user_high = max(ids)
 
-    def serialize(self):
+    @staticmethod
+    def pair_key(user1_id, user2_id):
         """
-        Serializes a Chat Object
+        Returns the (user_low, user_high) key of the chat between two users
         """
+        return min(user1_id, user2_id), max(user1_id, user2_id)
+
+    def serialize(self, messages=None):
+        """
+        Serializes a Chat Object with the given messages, or with all of its
+        messages if none are given
+        """
+        if messages is None:
+            messages = self.messages
         return {
             "id": self.id,
-            "messages": [m.serialize() for m in self.messages],
+            "messages": [m.serialize() for m in messages],
             "users":[u.simple_serialize() for u in self.users],
             "time": self.time
         }
 
+    SIMPLE_FIELDS = ("id", "time")
+
+    @staticmethod
+    def projection():
+        """
+        Returns the columns of a Chat that can be selected directly by name
+        """
+        return {
+            "id": Chat.id,
+            "time": Chat.time
+        }
+
+    @staticmethod
+    def serialize_options():
+        """
+        Returns the loader options for the relationships Chat.serialize touches.
+        Messages are not loaded, callers page them with chats_dao
+        """
+        return [
+            selectinload(Chat.users)
+        ]
+
     def simple_serialize(self):
         """
         Simple Serializes a Chat Object
@@ -443,10 +842,16 @@ class Message(db.Model):
     """
     __tablename__ = "message"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
-    sender_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable = False)
+    sender_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable = False, index = True)
     chat_id = db.Column(db.Integer, db.ForeignKey("chat.id"), nullable = False)
     message = db.Column(db.String, nullable = False)
     time = db.Column(db.String, nullable = False)
+    #Generated when the message is sent, before it has an id, so clients can
+    #tell apart messages they already received
+    uuid = db.Column(db.String, nullable = True)
+
+    #Backs loading a chat's messages in order
+    __table_args__ = (db.Index("ix_message_chat_id_id", "chat_id", "id"),)
 
     def __init__(self, **kwargs):
         """
@@ -455,7 +860,8 @@ class Message(db.Model):
         self.sender_id = kwargs.get("sender_id")
         self.chat_id = kwargs.get("chat")
         self.message = kwargs.get("message")
-        self.time = datetime.datetime.now()
+        self.time = str(datetime.datetime.now())
+        self.uuid = str(uuid4())
     
     def serialize(self):
         """
@@ -466,12 +872,154 @@ class Message(db.Model):
             "sender_id": self.sender_id,
             "chat_id": self.chat_id,
             "message": self.message,
-            "time": str(self.time)
+            "time": self.time,
+            "uuid": self.uuid
         }
-    
 
+#--------------------EMAILS------------------------------------------
+class Email(db.Model):
+    """
+    Email Model, an outgoing email waiting in the delivery queue
+    """
+    __tablename__ = "email"
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    recipient = db.Column(db.String, nullable = False)
+    subject = db.Column(db.String, nullable = False)
+    content = db.Column(db.String, nullable = False)
+    created_at = db.Column(db.DateTime, nullable = False)
+    attempts = db.Column(db.Integer, nullable = False)
+    next_attempt = db.Column(db.DateTime, nullable = False)
+    claim = db.Column(db.String, nullable = True)
+    #Delivered emails are deleted, so this is only set on rows from older versions
+    sent_at = db.Column(db.DateTime, nullable = True)
+    last_error = db.Column(db.String, nullable = True)
 
+    #Backs the lookup of emails that are due for delivery
+    __table_args__ = (db.Index("ix_email_sent_at_next_attempt", "sent_at", "next_attempt"),)
 
+    def __init__(self, **kwargs):
+        """
+        Creates an Email object, due for delivery right away
+        """
+        self.recipient = kwargs.get("recipient")
+        self.subject = kwargs.get("subject")
+        self.content = kwargs.get("content")
+        self.created_at = datetime.datetime.now()
+        self.attempts = 0
+        self.next_attempt = self.created_at
+
+#--------------------CACHE VERSIONS------------------------------------------
+class CacheVersion(db.Model):
+    """
+    CacheVersion Model, a counter per table that goes up in every transaction
+    that changes the table. Cached responses are keyed by the counters of the
+    tables they read, so any process can tell when they are out of date
+    """
+    __tablename__ = "cache_version"
+    name = db.Column(db.String, primary_key = True)
+    version = db.Column(db.Integer, nullable = False)
+
+    #Names of the tables some cached response reads, the only ones counted
+    tracked = set()
 
+    #Counters of some columns of a table, for responses that read only those.
+    #They go up when a row is inserted or deleted or one of the columns changes,
+    #so e.g. last seen times and session tokens don't change user_profile
+    PARTS = {"user_profile": ("user", {"first", "last", "email"})}
 
+    @staticmethod
+    def current(names):
+        """
+        Returns the counters of the given tables as a tuple, in the given order
+        """
+        rows = db.session.query(CacheVersion.name, CacheVersion.version).filter(CacheVersion.name.in_(names)).all()
+        versions = {row.name: row.version for row in rows}
+        return tuple(versions.get(name, 0) for name in names)
+
+    @staticmethod
+    def changed(table, columns=None):
+        """
+        Returns the counters a change to the given columns of a table moves
+        forward, or to whole rows if columns is None
+        """
+        names = {table}
+        for name, (part_table, part_columns) in CacheVersion.PARTS.items():
+            if part_table == table and (columns is None or part_columns.intersection(columns)):
+                names.add(name)
+        return names
 
+    @staticmethod
+    def record(session, names):
+        """
+        Remembers the tracked counters among names, to be moved forward when the
+        transaction of the session commits
+        """
+        session.info.setdefault("cache_versions", set()).update(CacheVersion.tracked.intersection(names))
+
+    @staticmethod
+    def bump(connection, names):
+        """
+        Moves counters forward as part of the transaction of the connection, one
+        row at a time in name order so concurrent transactions lock them in the
+        same order
+        """
+        table = CacheVersion.__table__
+        connection.execute(
+            table.update().where(table.c.name == db.bindparam("counter")).values(version = table.c.version + 1),
+            [{"counter": name} for name in sorted(names)]
+        )
+
+def updated_columns(statement):
+    """
+    Returns the names of the columns an UPDATE statement sets, or None if they
+    cannot be told
+    """
+    values = statement._values or dict(statement._ordered_values or ())
+    if not values:
+        return None
+    return {getattr(column, "key", column) for column in values}
+
+@event.listens_for(Session, "after_flush")
+def record_flushed_tables(session, flush_context):
+    """
+    Records a change to the tables of every object a flush wrote
+    """
+    for obj in list(session.new) + list(session.deleted):
+        CacheVersion.record(session, CacheVersion.changed(obj.__table__.name))
+    for obj in session.dirty:
+        columns = [attr.key for attr in db.inspect(obj).attrs if attr.history.has_changes()]
+        CacheVersion.record(session, CacheVersion.changed(obj.__table__.name, columns))
+
+@event.listens_for(Session, "do_orm_execute")
+def record_executed_tables(orm_execute_state):
+    """
+    Records a change to the table of every INSERT, UPDATE or DELETE statement
+    run through the session, which don't go through a flush
+    """
+    statement = orm_execute_state.statement
+    if orm_execute_state.is_insert or orm_execute_state.is_delete:
+        CacheVersion.record(orm_execute_state.session, CacheVersion.changed(statement.table.name))
+    elif orm_execute_state.is_update:
+        CacheVersion.record(orm_execute_state.session, CacheVersion.changed(statement.table.name, updated_columns(statement)))
+
+@event.listens_for(Session, "before_commit")
+def bump_committed_tables(session):
+    """
+    Moves forward the counters of every table the transaction changed, once,
+    right before it commits, so the counter rows stay locked as briefly as possible
+    """
+    if session.in_nested_transaction():
+        return
+    #commit flushes after this event, so flush first to record every change
+    session.flush()
+    names = session.info.pop("cache_versions", None)
+    if names:
+        CacheVersion.bump(session.connection(), names)
+
+@event.listens_for(Session, "after_transaction_end")
+def forget_rolled_back_tables(session, transaction):
+    """
+    Forgets the changes of a transaction that ended without committing
+    """
+    if transaction.parent is None:
+        session.info.pop("cache_versions", None)
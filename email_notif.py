@@ -1,19 +1,159 @@
+"""
+Email notifications file
+
+send_email only queues an email in the database. A background worker started
+by init_app delivers queued emails through the configured transport, batching
+identical emails to several recipients into one API call and retrying failed
+deliveries with exponential backoff. Delivered emails are deleted from the queue
+"""
+
+import datetime
+import os
+import threading
 from os import environ
+
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 
+from db import db, Email
+
+FROM_EMAIL = '123awesomeface123@gmail.com'
+
+# Recipients of the same subject and content sent in one API call
+EMAIL_BATCH_SIZE = int(environ.get("EMAIL_BATCH_SIZE", 100))
+EMAIL_MAX_ATTEMPTS = int(environ.get("EMAIL_MAX_ATTEMPTS", 5))
+EMAIL_RETRY_SECONDS = int(environ.get("EMAIL_RETRY_SECONDS", 30))
+EMAIL_POLL_SECONDS = int(environ.get("EMAIL_POLL_SECONDS", 5))
+# How long a worker owns the emails it claimed before another worker may retry them
+EMAIL_LEASE_SECONDS = int(environ.get("EMAIL_LEASE_SECONDS", 120))
+
+
+class SendGridTransport:
+    """
+    Delivers emails through SendGrid, reusing one API client
+    """
+
+    def __init__(self):
+        """
+        Creates the SendGrid client
+        """
+        self.client = SendGridAPIClient(environ.get('SENDGRID_API_KEY'))
+
+    def send(self, recipients, subject, content):
+        """
+        Sends one email to each recipient in a single API call, raising on failure
+        """
+        message = Mail(
+            from_email = FROM_EMAIL,
+            to_emails = recipients,
+            subject = subject,
+            html_content = content,
+            is_multiple = True)
+        self.client.send(message)
+
+
+class MemoryTransport:
+    """
+    Keeps delivered emails in a list instead of sending them, for tests and local runs
+    """
+
+    def __init__(self):
+        """
+        Creates an empty outbox
+        """
+        self.sent = []
+
+    def send(self, recipients, subject, content):
+        """
+        Records one email to each recipient
+        """
+        self.sent += [{"to": r, "subject": subject, "content": content} for r in recipients]
+
+
+TRANSPORTS = {
+    "sendgrid": SendGridTransport,
+    "memory": MemoryTransport
+}
+
+transport = None
+_wake = threading.Event()
+
+
+def init_app(app):
+    """
+    Creates the transport named by the EMAIL_TRANSPORT config value (default
+    "sendgrid") and starts the delivery worker
+    """
+    global transport
+    transport = TRANSPORTS[app.config.get("EMAIL_TRANSPORT", "sendgrid")]()
+    worker = threading.Thread(target=_deliver_forever, args=(app,), daemon=True)
+    worker.start()
 
 
 def send_email(to, subject, content):
-    sg = SendGridAPIClient(environ.get('SENDGRID_API_KEY'))
-    message = Mail(
-        from_email = '123awesomeface123@gmail.com',
-        to_emails = to,
-        subject = subject,
-        html_content = content)
-    
-    try:
-        response = sg.send(message)
-    except Exception as e:
-        print(e)
+    """
+    Queues an email for delivery, committing the current session
+    """
+    db.session.add(Email(recipient=to, subject=subject, content=content))
+    db.session.commit()
+    _wake.set()
+
+
+def deliver_due():
+    """
+    Claims the emails that are due and delivers them
+
+    Returns the number of emails claimed. Must be called inside an app context
+    """
+    now = datetime.datetime.now()
+    claim = os.urandom(16).hex()
+    due = [id for id, in db.session.query(Email.id).filter(
+        Email.sent_at.is_(None),
+        Email.attempts < EMAIL_MAX_ATTEMPTS,
+        Email.next_attempt <= now
+    ).order_by(Email.id).limit(EMAIL_BATCH_SIZE * 10)]
+    if not due:
+        db.session.commit()
+        return 0
+    #Another worker may have claimed some of them since, which pushed their next_attempt past now
+    Email.query.filter(Email.id.in_(due), Email.next_attempt <= now).update({
+        Email.claim: claim,
+        Email.next_attempt: now + datetime.timedelta(seconds=EMAIL_LEASE_SECONDS)
+    }, synchronize_session=False)
+    db.session.commit()
+
+    emails = Email.query.filter(Email.id.in_(due), Email.claim == claim).all()
+    groups = {}
+    for email in emails:
+        groups.setdefault((email.subject, email.content), []).append(email)
+
+    for (subject, content), group in groups.items():
+        for i in range(0, len(group), EMAIL_BATCH_SIZE):
+            batch = group[i:i + EMAIL_BATCH_SIZE]
+            try:
+                transport.send([email.recipient for email in batch], subject, content)
+                Email.query.filter(Email.id.in_([email.id for email in batch])).delete(synchronize_session=False)
+            except Exception as e:
+                print(f"Error when sending email: {e}")
+                for email in batch:
+                    email.attempts += 1
+                    email.next_attempt = datetime.datetime.now() + datetime.timedelta(seconds=EMAIL_RETRY_SECONDS * 2 ** (email.attempts - 1))
+                    email.last_error = str(e)
+            db.session.commit()
+    return len(emails)
+
 
+def _deliver_forever(app):
+    """
+    Delivers due emails whenever one is queued or every EMAIL_POLL_SECONDS
+    """
+    while True:
+        _wake.wait(EMAIL_POLL_SECONDS)
+        _wake.clear()
+        with app.app_context():
+            try:
+                while deliver_due():
+                    pass
+            except Exception as e:
+                print(f"Error when delivering emails: {e}")
+                db.session.rollback()
@@ -0,0 +1,150 @@
+"""
+Images file
+
+Helpers for reading and checking uploaded images, and the worker pool that
+makes the resized variants of new assets
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os import environ
+
+from PIL import Image
+
+import storage
+from db import db, Asset, AssetVariant
+
+MAX_UPLOAD_BYTES = int(environ.get("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of each supported image format, and its extension
+SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"GIF87a": "gif",
+    b"GIF89a": "gif",
+    b"\xff\xd8\xff": "jpg"
+}
+
+# Variants made for every asset: name -> (largest side in pixels, format or None to keep the original one)
+VARIANTS = {
+    "thumbnail": (160, None),
+    "medium": (640, None),
+    "webp": (640, "webp")
+}
+# Format, extension and save options of each output format
+FORMATS = {
+    "png": ("PNG", "png", {"optimize": True}),
+    "gif": ("PNG", "png", {"optimize": True}),
+    "jpg": ("JPEG", "jpg", {"quality": 80, "optimize": True, "progressive": True}),
+    "jpeg": ("JPEG", "jpg", {"quality": 80, "optimize": True, "progressive": True}),
+    "webp": ("WEBP", "webp", {"quality": 75, "method": 4})
+}
+VARIANT_WORKERS = int(environ.get("VARIANT_WORKERS", 2))
+
+_app = None
+_executor = ThreadPoolExecutor(max_workers=VARIANT_WORKERS)
+
+
+def read_upload(stream):
+    """
+    Reads an upload stream in chunks, giving up as soon as it grows past
+    MAX_UPLOAD_BYTES
+
+    Returns the bytes read, or None if the upload was too large
+    """
+    buffer = BytesIO()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return buffer.getvalue()
+        if buffer.tell() + len(chunk) > MAX_UPLOAD_BYTES:
+            return None
+        buffer.write(chunk)
+
+
+def validate_image(img_data):
+    """
+    Checks the signature and header of an image without decoding its pixels
+
+    Returns the extension of the image, or None if it is not a supported image
+    """
+    ext = next((ext for signature, ext in SIGNATURES.items() if img_data.startswith(signature)), None)
+    if ext is None:
+        return None
+    try:
+        Image.open(BytesIO(img_data))
+    except Exception:
+        return None
+    return ext
+
+
+def init_app(app):
+    """
+    Gives the variant workers the app whose database they write to
+    """
+    global _app
+    _app = app
+
+
+def generate_variants(asset):
+    """
+    Queues the creation of the resized variants of a newly stored asset
+    """
+    _executor.submit(_generate_variants, asset.id, asset.content_hash, asset.extension, asset.img_data)
+
+
+def _generate_variants(asset_id, content_hash, extension, img_data):
+    """
+    Records the variants of an asset, copying them from another asset with the
+    same content if it has them, otherwise resizing and recompressing the image
+    into every variant and uploading them
+    """
+    with _app.app_context():
+        try:
+            if Asset.query.filter_by(id = asset_id).first() is None:
+                return
+
+            existing = AssetVariant.query.join(Asset, Asset.id == AssetVariant.asset_id).filter(
+                Asset.content_hash == content_hash, Asset.id != asset_id
+            ).all()
+            copies = {variant.name: variant for variant in existing}
+            if set(copies) == set(VARIANTS):
+                for variant in copies.values():
+                    db.session.add(AssetVariant(
+                        asset_id = asset_id,
+                        name = variant.name,
+                        base_url = variant.base_url,
+                        filename = variant.filename,
+                        width = variant.width,
+                        height = variant.height
+                    ))
+                db.session.commit()
+                return
+
+            img = Image.open(BytesIO(img_data))
+            img.load()
+            for name, (size, output) in VARIANTS.items():
+                image_format, ext, options = FORMATS[output or extension]
+                variant = img.copy()
+                if image_format != "PNG" and variant.mode not in ("RGB", "L"):
+                    variant = variant.convert("RGB")
+                variant.thumbnail((size, size))
+
+                buffer = BytesIO()
+                variant.save(buffer, image_format, **options)
+                buffer.seek(0)
+                filename = f"{content_hash}_{name}.{ext}"
+                storage.get_storage().put(filename, buffer, Image.MIME[image_format])
+                db.session.add(AssetVariant(
+                    asset_id = asset_id,
+                    name = name,
+                    base_url = storage.get_storage().base_url,
+                    filename = filename,
+                    width = variant.width,
+                    height = variant.height
+                ))
+            db.session.commit()
+        except Exception as e:
+            print(f"Error when creating image variants: {e}")
+        finally:
+            db.session.rollback()
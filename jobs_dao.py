@@ -0,0 +1,135 @@
+"""
+DAO (Data Access Object) file for jobs
+
+Helper file containing functions for accessing jobs in our database
+"""
+
+import datetime
+import math
+from os import environ
+
+from db import db, Asset, Job, association_table_poster
+
+MAX_BULK_JOBS = int(environ.get("MAX_BULK_JOBS", 10000))
+BULK_BATCH_SIZE = 1000
+#Largest value of the integer duration column on PostgreSQL
+MAX_DURATION = 2 ** 31 - 1
+
+REQUIRED_STRING_FIELDS = ("title", "description", "location", "date_activity", "reward", "category", "relevant_skills")
+
+
+def validate_job(body):
+    """
+    Checks the fields of a job: the create job endpoint's required fields, text
+    fields that are strings, a whole duration that fits its column, and finite
+    coordinates in range. Converts them to the types of their columns
+
+    Returns if the job is valid, and its column values or an error message
+    """
+    if not isinstance(body, dict):
+        return False, "Job must be a json object"
+    if any(body.get(name) is None for name in REQUIRED_STRING_FIELDS + ("duration", "longtitude", "latitude")):
+        return False, "Missing one of the required fields"
+    other_notes = body.get("other_notes")
+    if any(not isinstance(body[name], str) for name in REQUIRED_STRING_FIELDS) or not isinstance(other_notes, (str, type(None))):
+        return False, f"{', '.join(REQUIRED_STRING_FIELDS)} and other_notes must be strings"
+    duration = _number(body["duration"])
+    if duration is None:
+        return False, "duration, longtitude and latitude must be numbers"
+    if isinstance(duration, float) and not duration.is_integer() or not 0 <= duration <= MAX_DURATION:
+        return False, f"duration must be a whole number from 0 to {MAX_DURATION}"
+    success, coordinates = validate_coordinates(body["latitude"], body["longtitude"])
+    if not success:
+        return False, coordinates
+
+    row = {name: body[name] for name in REQUIRED_STRING_FIELDS}
+    row["duration"] = int(duration)
+    row["latitude"], row["longtitude"] = coordinates
+    row["other_notes"] = other_notes
+    return True, row
+
+
+def validate_coordinates(latitude, longtitude):
+    """
+    Checks a latitude and a longtitude are finite numbers (or strings holding
+    them) in range
+
+    Returns if they are valid, and them as floats or an error message
+    """
+    latitude, longtitude = _number(latitude), _number(longtitude)
+    if latitude is None or longtitude is None:
+        return False, "longtitude and latitude must be numbers"
+    if not -90 <= latitude <= 90 or not -180 <= longtitude <= 180:
+        return False, "latitude must be from -90 to 90 and longtitude from -180 to 180"
+    return True, (float(latitude), float(longtitude))
+
+
+def _number(value):
+    """
+    Returns a json number, or a string holding one, as an int or float, or None
+    if it is not a finite number. Booleans are not numbers here, nor are NaN
+    and Infinity, which Python's json module accepts
+    """
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _allocate_ids(rows):
+    """
+    Returns ids for all rows, in order, and how many of the first rows it
+    already inserted
+
+    PostgreSQL hands out the ids from the job sequence. On SQLite the first
+    row is inserted, which takes the write lock, so nobody else can insert
+    until commit and the ids after the first one are free. Other databases
+    insert every row on its own
+    """
+    if db.engine.dialect.name == "postgresql":
+        ids = db.session.execute(
+            db.text("SELECT nextval(pg_get_serial_sequence('job', 'id')) FROM generate_series(1, :count)"),
+            {"count": len(rows)}
+        ).scalars().all()
+        return ids, 0
+
+    first_id = db.session.execute(Job.__table__.insert(), rows[0]).inserted_primary_key[0]
+    if db.engine.dialect.name == "sqlite":
+        return [first_id + i for i in range(len(rows))], 1
+    ids = [first_id] + [db.session.execute(Job.__table__.insert(), row).inserted_primary_key[0] for row in rows[1:]]
+    return ids, len(rows)
+
+
+def create_jobs(user, rows):
+    """
+    Creates jobs posted by a user from validated rows, in one transaction with
+    one executemany per BULK_BATCH_SIZE jobs
+
+    As with creating the jobs one by one, the user's latest image ends up
+    attached to the last job. Returns the ids of the jobs, in order
+    """
+    now = datetime.datetime.now()
+    rows = [{**row, "date_created": now, "done": False, "taken": False} for row in rows]
+    ids, inserted = _allocate_ids(rows)
+    for row, job_id in zip(rows, ids):
+        row["id"] = job_id
+
+    for start in range(inserted, len(rows), BULK_BATCH_SIZE):
+        db.session.execute(Job.__table__.insert(), rows[start:start + BULK_BATCH_SIZE])
+    for start in range(0, len(ids), BULK_BATCH_SIZE):
+        db.session.execute(
+            association_table_poster.insert(),
+            [{"job_id": job_id, "user_id": user.id} for job_id in ids[start:start + BULK_BATCH_SIZE]]
+        )
+
+    latest = Asset.query.filter_by(user_id = user.id).order_by(Asset.id.desc()).first()
+    if latest is not None:
+        latest.job_id = ids[-1]
+    db.session.commit()
+    return ids
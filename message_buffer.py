@@ -0,0 +1,150 @@
+"""
+Message buffer file
+
+Saves chat messages either right away or through a write-behind buffer,
+depending on MESSAGE_DURABILITY:
+
+"sync" (default): every message is committed before it is sent to the chat,
+so a message that was delivered is never lost
+
+"batch": messages are sent to the chat right away and a background worker
+writes them in batches, one transaction per batch of at most
+MESSAGE_BATCH_SIZE messages, started at most MESSAGE_BATCH_MS after the
+oldest message arrived. Messages still in the buffer are lost if the process
+crashes, and they have no id until they are written, only their uuid
+"""
+
+import atexit
+import datetime
+import queue
+import threading
+import time
+from os import environ
+from uuid import uuid4
+
+from db import db, Chat, Message
+
+MESSAGE_DURABILITY = environ.get("MESSAGE_DURABILITY", "sync")
+MESSAGE_BATCH_SIZE = int(environ.get("MESSAGE_BATCH_SIZE", 100))
+MESSAGE_BATCH_MS = int(environ.get("MESSAGE_BATCH_MS", 50))
+
+_app = None
+_buffer = queue.Queue()
+_write_lock = threading.Lock()
+
+
+def init_app(app):
+    """
+    Starts the writer of the buffer if messages are saved in batches
+    """
+    global _app
+    _app = app
+    if MESSAGE_DURABILITY == "batch":
+        worker = threading.Thread(target=_write_forever, daemon=True)
+        worker.start()
+        atexit.register(flush)
+
+
+def save_message(sender_id, chat_id, text):
+    """
+    Saves a message sent to a chat and moves the chat's time forward
+
+    Returns the serialized message, whose id is None if it was only buffered.
+    Its uuid is set either way, and is the same once the message is written
+    """
+    now = str(datetime.datetime.now())
+    if MESSAGE_DURABILITY != "batch":
+        message = Message(sender_id = sender_id, chat = chat_id, message = text)
+        message.time = now
+        db.session.add(message)
+        Chat.query.filter_by(id = chat_id).update({Chat.time: now})
+        db.session.commit()
+        return message.serialize()
+
+    row = {"sender_id": sender_id, "chat_id": chat_id, "message": text, "time": now, "uuid": str(uuid4())}
+    _buffer.put(row)
+    return {"id": None, **row}
+
+
+def flush():
+    """
+    Writes every buffered message
+    """
+    rows = _drain()
+    while rows:
+        _write(rows)
+        rows = _drain()
+
+
+def _drain():
+    """
+    Takes up to MESSAGE_BATCH_SIZE messages from the buffer without waiting
+    """
+    rows = []
+    while len(rows) < MESSAGE_BATCH_SIZE:
+        try:
+            rows.append(_buffer.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+
+def _next_batch():
+    """
+    Waits for a message, then collects more until the batch is full or
+    MESSAGE_BATCH_MS have passed since the first one
+    """
+    rows = [_buffer.get()]
+    deadline = time.monotonic() + MESSAGE_BATCH_MS / 1000
+    while len(rows) < MESSAGE_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            rows.append(_buffer.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return rows
+
+
+def _write(rows):
+    """
+    Inserts a batch of messages and updates the times of their chats in one
+    transaction. If the batch fails, its messages are written one by one so
+    only the bad ones (e.g. of a deleted chat) are dropped
+    """
+    with _write_lock, _app.app_context():
+        try:
+            _insert(rows)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error when writing a batch of messages: {e}")
+            for row in rows:
+                try:
+                    _insert([row])
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error when writing a message, dropping it: {e}")
+
+
+def _insert(rows):
+    """
+    Inserts messages with one executemany and commits them
+    """
+    chat_times = {}
+    for row in rows:
+        chat_times[row["chat_id"]] = row["time"]
+    db.session.execute(Message.__table__.insert(), rows)
+    db.session.execute(
+        Chat.__table__.update().where(Chat.id == db.bindparam("chat_id")).values(time = db.bindparam("chat_time")),
+        [{"chat_id": chat_id, "chat_time": chat_time} for chat_id, chat_time in chat_times.items()]
+    )
+    db.session.commit()
+
+
+def _write_forever():
+    """
+    Writes buffered messages in batches
+    """
+    while True:
+        _write(_next_batch())
@@ -0,0 +1,163 @@
+"""
+Migrations file
+
+Brings an existing database up to the current schema. db.create_all only
+creates missing tables, so changes to tables that already exist are applied
+here, in order, and recorded in the schema_version table. Every migration is
+safe to run on a database created from the current models
+"""
+
+import users_dao
+from db import RATES, db
+
+ASSOCIATION_TABLES = {
+    "association_poster": ("job_id", "user_id"),
+    "association_receiver": ("job_id", "user_id"),
+    "association_potential": ("job_id", "user_id"),
+    "association_rating_poster": ("rating_id", "user_id"),
+    "association_rating_postee": ("rating_id", "user_id"),
+    "association_chat": ("chat_id", "user_id")
+}
+
+
+def add_column(table, column, ddl):
+    """
+    Adds a column to a table unless it already has it
+    """
+    columns = [c["name"] for c in db.inspect(db.engine).get_columns(table)]
+    if column not in columns:
+        db.session.execute(db.text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+
+def add_asset_content_hash():
+    """
+    Adds the content hash used to deduplicate stored images
+    """
+    add_column("asset", "content_hash", "VARCHAR")
+
+
+def key_association_tables():
+    """
+    Removes duplicate rows from the association tables and makes both of their
+    columns a unique key. Tables created before they had a primary key get a
+    unique index instead, since SQLite cannot add one to an existing table
+    """
+    for table, (first, second) in ASSOCIATION_TABLES.items():
+        if db.inspect(db.engine).get_pk_constraint(table)["constrained_columns"]:
+            continue
+        if db.engine.dialect.name == "sqlite":
+            db.session.execute(db.text(
+                f"DELETE FROM {table} WHERE rowid NOT IN "
+                f"(SELECT MIN(rowid) FROM {table} GROUP BY {first}, {second})"
+            ))
+        else:
+            db.session.execute(db.text(
+                f"DELETE FROM {table} a USING {table} b "
+                f"WHERE a.ctid > b.ctid AND a.{first} = b.{first} AND a.{second} = b.{second}"
+            ))
+        db.session.execute(db.text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table} ON {table} ({first}, {second})"
+        ))
+
+
+def add_user_rating_totals():
+    """
+    Adds the rating totals of users and fills them from the existing ratings
+    """
+    for column in ["rating_count", "rating_sum"] + [f"rating_{rate}" for rate in RATES]:
+        add_column("user", column, "INTEGER NOT NULL DEFAULT 0")
+    users_dao.rebuild_rating_totals()
+
+
+def add_chat_user_pair():
+    """
+    Adds the user pair key of chats and fills it from the chat members
+    """
+    add_column("chat", "user_low", "INTEGER")
+    add_column("chat", "user_high", "INTEGER")
+    db.session.execute(db.text(
+        "UPDATE chat SET "
+        "user_low = (SELECT MIN(user_id) FROM association_chat WHERE chat_id = chat.id), "
+        "user_high = (SELECT MAX(user_id) FROM association_chat WHERE chat_id = chat.id) "
+        "WHERE user_low IS NULL"
+    ))
+
+
+def add_user_last_seen():
+    """
+    Adds the time users were last connected to the chat
+    """
+    add_column("user", "last_seen", "TIMESTAMP")
+
+
+def add_job_status():
+    """
+    Adds the status of jobs and fills it from their taken and done flags
+    """
+    add_column("job", "status", "VARCHAR NOT NULL DEFAULT 'open'")
+    db.session.execute(db.text(
+        "UPDATE job SET status = CASE WHEN done THEN 'done' WHEN taken THEN 'taken' ELSE 'open' END"
+    ))
+
+
+def narrow_job_search_trigger():
+    """
+    Drops the full-text index trigger that ran on every update of a job, so
+    init_search_index recreates it to run only when an indexed column changes
+    """
+    if db.engine.dialect.name == "sqlite":
+        db.session.execute(db.text("DROP TRIGGER IF EXISTS job_search_update"))
+
+
+def add_message_uuid():
+    """
+    Adds the key clients use to tell apart messages they already received
+    """
+    add_column("message", "uuid", "VARCHAR")
+
+
+def prune_sent_emails():
+    """
+    Deletes the emails that were delivered before sent emails were removed from the queue
+    """
+    db.session.execute(db.text("DELETE FROM email WHERE sent_at IS NOT NULL"))
+
+
+MIGRATIONS = [
+    add_asset_content_hash,
+    key_association_tables,
+    add_user_rating_totals,
+    add_chat_user_pair,
+    add_user_last_seen,
+    add_job_status,
+    narrow_job_search_trigger,
+    add_message_uuid,
+    prune_sent_emails
+]
+
+
+def create_missing_indexes():
+    """
+    Creates every index declared on the models that the database lacks
+    """
+    for table in db.Model.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def upgrade():
+    """
+    Applies the migrations the database has not had yet, then creates any
+    missing indexes
+
+    Must be called inside an app context, after db.create_all
+    """
+    db.session.execute(db.text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    current = db.session.execute(db.text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version > current:
+            migration()
+            db.session.execute(db.text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": version})
+            db.session.commit()
+    db.session.commit()
+    create_missing_indexes()
@@ -0,0 +1,172 @@
+"""
+Passwords file
+
+Helper file that hashes and checks passwords with bcrypt on a bounded pool of
+worker processes, so the hashing never ties up the process serving requests.
+Under eventlet or gevent (see init_app) requests wait for the pool from a
+native thread, so other green threads keep running while a password is hashed.
+The workers are started by a forkserver (or spawned where there is none)
+rather than forked from the server, whose background threads may hold locks
+at the time of the fork
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from os import environ
+
+import bcrypt
+
+BCRYPT_ROUNDS = int(environ.get("BCRYPT_ROUNDS", 13))
+BCRYPT_WORKERS = int(environ.get("BCRYPT_WORKERS", os.cpu_count() or 1))
+BCRYPT_MAX_PENDING = int(environ.get("BCRYPT_MAX_PENDING", 64))
+BCRYPT_TIMEOUT_SECONDS = float(environ.get("BCRYPT_TIMEOUT_SECONDS", 30))
+
+# Upper bounds (in milliseconds) of the hash latency histogram buckets
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000)
+
+_pool = None
+_async_mode = "threading"
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(BCRYPT_MAX_PENDING)
+_pending = 0
+_latency_counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+_latency_total_ms = 0.0
+
+
+def _hashpw(password, rounds):
+    """
+    Hashes a password in a worker process
+    """
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds)).decode("utf8")
+
+
+def _checkpw(password, digest):
+    """
+    Checks a password against its digest in a worker process
+    """
+    return bcrypt.checkpw(password, digest)
+
+
+def _get_pool():
+    """
+    Returns the worker pool, starting it on first use
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                context.set_forkserver_preload(["passwords"])
+            _pool = ProcessPoolExecutor(max_workers=BCRYPT_WORKERS, mp_context=context)
+        return _pool
+
+
+def init_app(socketio):
+    """
+    Starts the worker pool and makes waiting for it cooperative under the async
+    mode of the server. Called before the app starts its background threads
+    """
+    global _async_mode
+    _async_mode = socketio.async_mode
+    _get_pool()
+
+
+def _wait(function, *args):
+    """
+    Calls a function that blocks its thread until the pool is done. Without
+    monkey patching, that would block every green thread under eventlet or
+    gevent, so there it is called from their native thread pool instead
+    """
+    if _async_mode == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(function, *args)
+    if _async_mode.startswith("gevent"):
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+
+def _run(function, *args):
+    """
+    Runs a function on the worker pool and waits for its result
+    """
+    return _wait(_submit, function, *args)
+
+
+def _submit(function, *args):
+    """
+    Submits a function to the worker pool and waits for its result, recording
+    how long it took. At most BCRYPT_MAX_PENDING calls are queued at once, any
+    more wait for a free slot. Raises TimeoutError if the result takes longer
+    than BCRYPT_TIMEOUT_SECONDS
+    """
+    global _pending, _latency_total_ms
+    with _slots:
+        with _lock:
+            _pending += 1
+        start = time.perf_counter()
+        try:
+            future = _get_pool().submit(function, *args)
+            try:
+                return future.result(timeout=BCRYPT_TIMEOUT_SECONDS)
+            except TimeoutError:
+                future.cancel()
+                raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound), len(LATENCY_BUCKETS_MS))
+            with _lock:
+                _pending -= 1
+                _latency_counts[bucket] += 1
+                _latency_total_ms += elapsed_ms
+
+
+def _encode(value):
+    """
+    Returns value as bytes, since digests may be stored as either str or bytes
+    """
+    return value.encode("utf8") if isinstance(value, str) else value
+
+
+def hash_password(password):
+    """
+    Returns the bcrypt digest of a password at the configured cost
+    """
+    return _run(_hashpw, _encode(password), BCRYPT_ROUNDS)
+
+
+def check_password(password, digest):
+    """
+    Returns true if the password matches the digest
+    """
+    return _run(_checkpw, _encode(password), _encode(digest))
+
+
+def needs_rehash(digest):
+    """
+    Returns true if the digest was made with a different cost than the configured one
+    """
+    return int(_encode(digest).split(b"$")[2]) != BCRYPT_ROUNDS
+
+
+def metrics():
+    """
+    Returns the current queue depth and the hash latency histogram of the pool
+    """
+    with _lock:
+        count = sum(_latency_counts)
+        buckets = {f"le_{bound}": n for bound, n in zip(LATENCY_BUCKETS_MS, _latency_counts)}
+        buckets["le_inf"] = _latency_counts[-1]
+        return {
+            "rounds": BCRYPT_ROUNDS,
+            "workers": BCRYPT_WORKERS,
+            "max_pending": BCRYPT_MAX_PENDING,
+            "queue_depth": _pending,
+            "count": count,
+            "mean_ms": _latency_total_ms / count if count else None,
+            "latency_ms": buckets
+        }
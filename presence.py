@@ -0,0 +1,198 @@
+"""
+Presence file
+
+Tracks which users have a chat socket open on this process and who is typing
+in which chat, entirely in memory, and broadcasts changes to the rooms of the
+users' chats. Typing flags expire after TYPING_TTL_SECONDS unless renewed.
+Last seen times are collected in memory and written to the database in one
+batch every PRESENCE_FLUSH_SECONDS
+
+With several processes (see SOCKETIO_MESSAGE_QUEUE) each process knows only
+its own sockets, but the events it emits reach every process
+"""
+
+import atexit
+import datetime
+import threading
+import time
+from os import environ
+
+from db import db, User, association_table_chat
+
+NAMESPACE = "/api/chat/"
+TYPING_TTL_SECONDS = int(environ.get("TYPING_TTL_SECONDS", 5))
+PRESENCE_FLUSH_SECONDS = int(environ.get("PRESENCE_FLUSH_SECONDS", 30))
+SWEEP_SECONDS = 1
+
+_app = None
+_socketio = None
+_lock = threading.Lock()
+# Socket id -> user id, and user id -> socket ids of that user
+_user_by_sid = {}
+_sids_by_user = {}
+# (chat id, user id) -> time (time.monotonic) the typing flag expires
+_typing = {}
+# User id -> last seen time not yet written to the database
+_last_seen = {}
+
+
+def init_app(app, socketio):
+    """
+    Starts the task that expires typing flags and writes last seen times
+    """
+    global _app, _socketio
+    _app = app
+    _socketio = socketio
+    socketio.start_background_task(_sweep_forever)
+    atexit.register(flush)
+
+
+def user_of(sid):
+    """
+    Returns the id of the user of a socket, or None if it is anonymous
+    """
+    return _user_by_sid.get(sid)
+
+
+def connected(sid, user_id):
+    """
+    Records a socket of a user, announcing the user as online if it is their
+    first one
+    """
+    with _lock:
+        _user_by_sid[sid] = user_id
+        sids = _sids_by_user.setdefault(user_id, set())
+        first = not sids
+        sids.add(sid)
+        _last_seen[user_id] = datetime.datetime.now()
+    if first:
+        _broadcast_presence(user_id, True)
+
+
+def disconnected(sid):
+    """
+    Forgets a socket, announcing its user as offline if it was their last one
+    """
+    with _lock:
+        user_id = _user_by_sid.pop(sid, None)
+        if user_id is None:
+            return
+        sids = _sids_by_user.get(user_id, set())
+        sids.discard(sid)
+        last = not sids
+        if last:
+            del _sids_by_user[user_id]
+            for key in [key for key in _typing if key[1] == user_id]:
+                del _typing[key]
+        _last_seen[user_id] = datetime.datetime.now()
+    if last:
+        _broadcast_presence(user_id, False)
+
+
+def set_typing(chat_id, user_id, typing):
+    """
+    Sets or clears the typing flag of a user in a chat, telling the chat when
+    it changes
+    """
+    key = (chat_id, user_id)
+    with _lock:
+        changed = (key in _typing) != typing
+        if typing:
+            _typing[key] = time.monotonic() + TYPING_TTL_SECONDS
+        else:
+            _typing.pop(key, None)
+    if changed:
+        _emit_typing(chat_id, user_id, typing)
+
+
+def get_presence(user_ids):
+    """
+    Returns whether each user is online and when they were last seen
+    """
+    users = db.session.query(User.id, User.last_seen).filter(User.id.in_(user_ids)).all()
+    with _lock:
+        return {
+            str(user.id): {
+                "online": user.id in _sids_by_user,
+                "last_seen": _format(_last_seen.get(user.id) or user.last_seen)
+            }
+            for user in users
+        }
+
+
+def _format(seen):
+    """
+    Returns a last seen time as a string, or None if the user was never seen
+    """
+    return str(seen) if seen is not None else None
+
+
+def flush():
+    """
+    Writes the collected last seen times to the database in one statement
+    """
+    with _lock:
+        pending = dict(_last_seen)
+        _last_seen.clear()
+    if not pending:
+        return
+    with _app.app_context():
+        try:
+            db.session.execute(
+                User.__table__.update().where(User.id == db.bindparam("user_id")).values(last_seen = db.bindparam("seen")),
+                [{"user_id": user_id, "seen": seen} for user_id, seen in pending.items()]
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error when writing last seen times: {e}")
+
+
+def _chat_ids(user_id):
+    """
+    Returns the ids of the chats of a user
+    """
+    with _app.app_context():
+        rows = db.session.query(association_table_chat.c.chat_id).filter(association_table_chat.c.user_id == user_id).all()
+        return [row.chat_id for row in rows]
+
+
+def _broadcast_presence(user_id, online):
+    """
+    Tells the rooms of every chat of a user that they came online or went offline
+    """
+    data = {"user_id": user_id, "online": online}
+    if not online:
+        data["last_seen"] = str(datetime.datetime.now())
+    for chat_id in _chat_ids(user_id):
+        _socketio.emit("presence", data, namespace=NAMESPACE, to=str(chat_id))
+
+
+def _emit_typing(chat_id, user_id, typing):
+    """
+    Tells the room of a chat that a user started or stopped typing
+    """
+    _socketio.emit("typing", {"chat_id": chat_id, "user_id": user_id, "typing": typing}, namespace=NAMESPACE, to=str(chat_id))
+
+
+def _sweep_forever():
+    """
+    Clears expired typing flags every second and writes last seen times every
+    PRESENCE_FLUSH_SECONDS
+    """
+    next_flush = time.monotonic() + PRESENCE_FLUSH_SECONDS
+    while True:
+        _socketio.sleep(SWEEP_SECONDS)
+        now = time.monotonic()
+        try:
+            with _lock:
+                expired = [key for key, expires in _typing.items() if expires <= now]
+                for key in expired:
+                    del _typing[key]
+            for chat_id, user_id in expired:
+                _emit_typing(chat_id, user_id, False)
+            if now >= next_flush:
+                flush()
+                next_flush = now + PRESENCE_FLUSH_SECONDS
+        except Exception as e:
+            print(f"Error when sweeping presence: {e}")
@@ -0,0 +1,216 @@
+"""
+Search file
+
+Helper file containing the full-text and location search indexes over jobs
+
+On SQLite these are an FTS5 and an R*-tree virtual table kept in sync by
+triggers, on PostgreSQL a GIN index over a weighted tsvector and a btree
+index over the coordinates
+"""
+
+import math
+import re
+
+from db import db, Job
+
+# Columns of the job table covered by the index, with their bm25 weights
+SEARCH_COLUMNS = {
+    "title": 10.0,
+    "description": 1.0,
+    "category": 5.0,
+    "relevant_skills": 3.0,
+    "location": 2.0
+}
+
+# The same columns weighted as a PostgreSQL text search document
+SEARCH_DOCUMENT = (
+    "(setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(category, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(relevant_skills, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(location, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'D'))"
+)
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+
+def is_sqlite():
+    """
+    Returns true if the database is SQLite
+    """
+    return db.engine.dialect.name == "sqlite"
+
+
+def init_search_index():
+    """
+    Creates the FTS5 index over jobs and the triggers that keep it in sync with
+    the job table, then fills it from the existing jobs if it was just created.
+    On PostgreSQL, creates the GIN index instead
+
+    Must be called inside an app context
+    """
+    if not is_sqlite():
+        db.session.execute(db.text(f"CREATE INDEX IF NOT EXISTS ix_job_search ON job USING gin ({SEARCH_DOCUMENT})"))
+        db.session.commit()
+        return
+
+    columns = ", ".join(SEARCH_COLUMNS)
+    new_columns = ", ".join(f"new.{column}" for column in SEARCH_COLUMNS)
+    old_columns = ", ".join(f"old.{column}" for column in SEARCH_COLUMNS)
+
+    exists = db.session.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'job_search'"
+    )).first()
+    if exists is None:
+        db.session.execute(db.text(
+            f"CREATE VIRTUAL TABLE job_search USING fts5({columns}, "
+            "content='job', content_rowid='id', prefix='2 3')"
+        ))
+        db.session.execute(db.text("INSERT INTO job_search(job_search) VALUES('rebuild')"))
+
+    db.session.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS job_search_insert AFTER INSERT ON job BEGIN "
+        f"INSERT INTO job_search(rowid, {columns}) VALUES (new.id, {new_columns}); "
+        "END"
+    ))
+    db.session.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS job_search_delete AFTER DELETE ON job BEGIN "
+        f"INSERT INTO job_search(job_search, rowid, {columns}) VALUES ('delete', old.id, {old_columns}); "
+        "END"
+    ))
+    db.session.execute(db.text(
+        f"CREATE TRIGGER IF NOT EXISTS job_search_update AFTER UPDATE OF {columns} ON job BEGIN "
+        f"INSERT INTO job_search(job_search, rowid, {columns}) VALUES ('delete', old.id, {old_columns}); "
+        f"INSERT INTO job_search(rowid, {columns}) VALUES (new.id, {new_columns}); "
+        "END"
+    ))
+    db.session.commit()
+
+
+def build_match_query(search):
+    """
+    Turns a search string into an FTS5 (or on PostgreSQL, tsquery) query where
+    every word must match the start of a word in the job
+    """
+    words = re.findall(r"\w+", search.lower())
+    if not is_sqlite():
+        return " & ".join(f"{word}:*" for word in words)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_jobs(search, limit, offset):
+    """
+    Returns up to limit jobs matching the search string, best match first,
+    skipping the first offset matches
+    """
+    match = build_match_query(search)
+    if not match:
+        return []
+
+    if is_sqlite():
+        weights = ", ".join(str(weight) for weight in SEARCH_COLUMNS.values())
+        query = ("SELECT rowid FROM job_search WHERE job_search MATCH :match "
+            f"ORDER BY bm25(job_search, {weights}) LIMIT :limit OFFSET :offset")
+    else:
+        query = (f"SELECT id FROM job WHERE {SEARCH_DOCUMENT} @@ to_tsquery('simple', :match) "
+            f"ORDER BY ts_rank({SEARCH_DOCUMENT}, to_tsquery('simple', :match)) DESC, id DESC "
+            "LIMIT :limit OFFSET :offset")
+    rows = db.session.execute(db.text(query), {"match": match, "limit": limit, "offset": offset})
+    ranks = {row[0]: rank for rank, row in enumerate(rows)}
+
+    jobs = Job.query.options(*Job.serialize_options()).filter(Job.id.in_(ranks)).all()
+    jobs.sort(key=lambda job: ranks[job.id])
+    return jobs
+
+
+def init_location_index():
+    """
+    Creates the R*-tree index over job coordinates and the triggers that keep it
+    in sync with the job table, then fills it from the existing jobs if it was
+    just created. On PostgreSQL, creates the btree index instead
+
+    Must be called inside an app context
+    """
+    if not is_sqlite():
+        db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_job_latitude_longtitude ON job (latitude, longtitude)"))
+        db.session.commit()
+        return
+
+    exists = db.session.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'job_location'"
+    )).first()
+    if exists is None:
+        db.session.execute(db.text(
+            "CREATE VIRTUAL TABLE job_location USING rtree("
+            "id, min_latitude, max_latitude, min_longtitude, max_longtitude)"
+        ))
+        db.session.execute(db.text(
+            "INSERT INTO job_location SELECT id, latitude, latitude, longtitude, longtitude FROM job"
+        ))
+
+    db.session.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS job_location_insert AFTER INSERT ON job BEGIN "
+        "INSERT INTO job_location VALUES (new.id, new.latitude, new.latitude, new.longtitude, new.longtitude); "
+        "END"
+    ))
+    db.session.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS job_location_delete AFTER DELETE ON job BEGIN "
+        "DELETE FROM job_location WHERE id = old.id; "
+        "END"
+    ))
+    db.session.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS job_location_update AFTER UPDATE OF latitude, longtitude ON job BEGIN "
+        "UPDATE job_location SET min_latitude = new.latitude, max_latitude = new.latitude, "
+        "min_longtitude = new.longtitude, max_longtitude = new.longtitude WHERE id = new.id; "
+        "END"
+    ))
+    db.session.commit()
+
+
+def distance_km(latitude1, longtitude1, latitude2, longtitude2):
+    """
+    Returns the great-circle distance between two points in kilometers
+    """
+    latitude1, longtitude1, latitude2, longtitude2 = map(math.radians, (latitude1, longtitude1, latitude2, longtitude2))
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2
+        + math.cos(latitude1) * math.cos(latitude2) * math.sin((longtitude2 - longtitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def jobs_near(latitude, longtitude, radius_km, limit, offset):
+    """
+    Returns up to limit (job, distance in km) pairs for the jobs within radius_km
+    of the given point, closest first, skipping the first offset matches
+
+    Only the jobs inside the bounding box of the circle are read, through the
+    location index
+    """
+    latitude_delta = radius_km / KM_PER_DEGREE
+    longtitude_delta = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    if is_sqlite():
+        query = ("SELECT job.id, job.latitude, job.longtitude FROM job_location "
+            "JOIN job ON job.id = job_location.id "
+            "WHERE max_latitude >= :min_latitude AND min_latitude <= :max_latitude "
+            "AND max_longtitude >= :min_longtitude AND min_longtitude <= :max_longtitude")
+    else:
+        query = ("SELECT id, latitude, longtitude FROM job "
+            "WHERE latitude BETWEEN :min_latitude AND :max_latitude "
+            "AND longtitude BETWEEN :min_longtitude AND :max_longtitude")
+    rows = db.session.execute(db.text(query), {
+        "min_latitude": latitude - latitude_delta,
+        "max_latitude": latitude + latitude_delta,
+        "min_longtitude": longtitude - longtitude_delta,
+        "max_longtitude": longtitude + longtitude_delta
+    })
+
+    distances = {}
+    for job_id, job_latitude, job_longtitude in rows:
+        distance = distance_km(latitude, longtitude, job_latitude, job_longtitude)
+        if distance <= radius_km:
+            distances[job_id] = distance
+    page = sorted(distances, key=lambda job_id: (distances[job_id], job_id))[offset:offset + limit]
+
+    jobs = Job.query.options(*Job.serialize_options()).filter(Job.id.in_(page)).all()
+    jobs.sort(key=lambda job: (distances[job.id], job.id))
+    return [(job, distances[job.id]) for job in jobs]
@@ -0,0 +1,59 @@
+"""
+Serializer file
+
+Encodes response bodies as JSON with orjson when it is installed, falling
+back to the standard library otherwise (JSON_BACKEND picks one explicitly).
+Datetimes are encoded here, in the "YYYY-MM-DD HH:MM:SS.ffffff" form the API
+has always used, so serialize methods can return them as they are
+"""
+
+import datetime
+import json
+from os import environ
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = environ.get("JSON_BACKEND", "json" if orjson is None else "orjson")
+# Items encoded together before a chunk of a streamed list is handed out
+STREAM_CHUNK_ITEMS = int(environ.get("STREAM_CHUNK_ITEMS", 100))
+
+
+def _default(value):
+    """
+    Encodes the values JSON has no type for
+    """
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(data):
+    """
+    Returns the JSON encoding of data as a string
+    """
+    if JSON_BACKEND == "orjson":
+        return orjson.dumps(data, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode("utf8")
+    return json.dumps(data, default=_default)
+
+
+def iter_list(key, items, **extra):
+    """
+    Yields the JSON encoding of {key: [items], **extra} in chunks of
+    STREAM_CHUNK_ITEMS items, so a large list never has to be encoded (or
+    built) all at once
+    """
+    yield "{" + dumps(key) + ": ["
+    separator = ""
+    chunk = []
+    for item in items:
+        chunk.append(dumps(item))
+        if len(chunk) == STREAM_CHUNK_ITEMS:
+            yield separator + ", ".join(chunk)
+            separator = ", "
+            chunk = []
+    if chunk:
+        yield separator + ", ".join(chunk)
+    yield "]" + "".join(f", {dumps(name)}: {dumps(value)}" for name, value in extra.items()) + "}"
@@ -0,0 +1,97 @@
+"""
+Storage file
+
+Object storage backends for uploaded images. Both backends take file-like
+objects and store them without writing temporary files
+"""
+
+import os
+import shutil
+import threading
+from os import environ
+
+import boto3
+from botocore.config import Config
+
+STORAGE_BACKEND = environ.get("STORAGE_BACKEND", "s3")
+S3_BUCKET_NAME = environ.get("S3_BUCKET_NAME")
+S3_REGION = environ.get("S3_REGION", "us-east-2")
+S3_MAX_CONNECTIONS = int(environ.get("S3_MAX_CONNECTIONS", 20))
+LOCAL_STORAGE_DIR = environ.get("LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "assets"))
+LOCAL_STORAGE_URL = environ.get("LOCAL_STORAGE_URL", "/static/assets")
+
+
+class S3Storage:
+    """
+    Stores objects in an S3 bucket through one shared, pooled client
+    """
+
+    def __init__(self, bucket, region):
+        """
+        Creates the S3 client
+        """
+        self.bucket = bucket
+        self.base_url = f"https://{bucket}.s3.{region}.amazonaws.com"
+        self.client = boto3.client("s3", region_name=region, config=Config(max_pool_connections=S3_MAX_CONNECTIONS))
+
+    def put(self, key, fileobj, content_type):
+        """
+        Streams a file-like object into the bucket as a publicly readable object
+        """
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs={"ACL": "public-read", "ContentType": content_type})
+
+    def delete(self, key):
+        """
+        Deletes an object from the bucket
+        """
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class LocalStorage:
+    """
+    Stores objects in a local directory served by the app, standing in for S3
+    in tests and local runs
+    """
+
+    def __init__(self, root, base_url):
+        """
+        Creates the storage directory if needed
+        """
+        self.root = root
+        self.base_url = base_url
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, key, fileobj, content_type):
+        """
+        Copies a file-like object into the storage directory
+        """
+        with open(os.path.join(self.root, key), "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+
+    def delete(self, key):
+        """
+        Deletes an object from the storage directory
+        """
+        try:
+            os.remove(os.path.join(self.root, key))
+        except FileNotFoundError:
+            pass
+
+
+_storage = None
+_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    Returns the storage backend named by STORAGE_BACKEND ("s3" or "local"),
+    creating it on first use
+    """
+    global _storage
+    with _lock:
+        if _storage is None:
+            if STORAGE_BACKEND == "local":
+                _storage = LocalStorage(LOCAL_STORAGE_DIR, LOCAL_STORAGE_URL)
+            else:
+                _storage = S3Storage(S3_BUCKET_NAME, S3_REGION)
+        return _storage
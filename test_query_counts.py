@@ -0,0 +1,121 @@
+"""
+Query count tests
+
+Seeds N and then 2N rows of every kind and checks that each list endpoint
+runs the same number of queries both times, so a relationship that is
+lazy loaded per row (an N+1 query) fails here instead of in production
+
+Run with "python -m pytest" from the repository root
+"""
+
+import io
+import json
+import os
+import tempfile
+import threading
+
+_data_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///%s" % os.path.join(_data_dir, "query_counts.db")
+os.environ["EMAIL_TRANSPORT"] = "memory"
+os.environ["STORAGE_BACKEND"] = "local"
+os.environ["LOCAL_STORAGE_DIR"] = _data_dir
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+import pytest
+from PIL import Image
+from sqlalchemy import event
+
+from app import app, socketio
+from db import db
+
+ROWS = 3
+# {owner} is the user every seeded user has a chat with
+LIST_ENDPOINTS = ["/api/user/", "/api/job/", "/api/rating/", "/api/asset/", "/api/job/filter/?search=title", "/api/chat/{owner}/"]
+
+
+def _png():
+    """
+    Returns the bytes of a small png image
+    """
+    buffer = io.BytesIO()
+    Image.new("RGB", (50, 50), (1, 2, 3)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _seed(client, chat_owner, count):
+    """
+    Registers count users, each with an image, a job, a rating of the previous
+    user and a chat with a message to chat_owner. Returns the ids of the users
+    """
+    png = _png()
+    ids = []
+    for _ in range(count):
+        response = client.post("/api/register/", data=json.dumps({
+            "email": f"user{len(ids)}-{os.urandom(4).hex()}@example.com",
+            "password": "password",
+            "first": "first",
+            "last": "last",
+            "phone_number": 1
+        }))
+        user_id = json.loads(response.get_data(as_text=True))["id"]
+        client.post(f"/api/user/{user_id}/upload/file/", data=png, content_type="image/png")
+        client.post(f"/api/user/{user_id}/job/", data=json.dumps({
+            "title": "title", "description": "description", "location": "location",
+            "date_activity": "today", "duration": 1, "reward": "reward", "category": "category",
+            "longtitude": 1.5, "latitude": 2.5, "relevant_skills": "skills"
+        }))
+        if ids:
+            client.post(f"/api/user/{user_id}/rating/{ids[-1]}/", data=json.dumps({"rate": 3, "description": "description"}))
+        if chat_owner is not None:
+            chat_client = socketio.test_client(app, namespace="/api/chat/")
+            chat_client.emit("new_chat", {"sender_id": user_id, "receiver_id": chat_owner}, namespace="/api/chat/")
+            chat_client.emit("private_message", {"sender_id": user_id, "receiver_id": chat_owner, "msg": "hi"}, namespace="/api/chat/")
+            chat_client.disconnect(namespace="/api/chat/")
+        ids.append(user_id)
+    return ids
+
+
+@pytest.fixture(scope="module")
+def counts():
+    """
+    Returns the number of queries of every list endpoint after seeding ROWS
+    and after seeding ROWS more
+    """
+    client = app.test_client()
+    thread = threading.get_ident()
+    executed = [0]
+
+    def count(*args):
+        # Background workers (emails, image variants) also query the database
+        if threading.get_ident() == thread:
+            executed[0] += 1
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", count)
+
+    owner = _seed(client, None, 1)[0]
+
+    def measure(path):
+        # A query parameter of its own keeps each request out of the response cache
+        path = path.format(owner = owner)
+        separator = "&" if "?" in path else "?"
+        executed[0] = 0
+        response = client.get(f"{path}{separator}query_count={os.urandom(4).hex()}")
+        assert response.status_code == 200
+        return executed[0]
+
+    results = {path: [] for path in LIST_ENDPOINTS}
+    for _ in range(2):
+        _seed(client, owner, ROWS)
+        for path in LIST_ENDPOINTS:
+            results[path].append(measure(path))
+    return results
+
+
+@pytest.mark.parametrize("path", LIST_ENDPOINTS)
+def test_query_count_does_not_grow_with_rows(counts, path):
+    """
+    Each list endpoint runs as many queries for 2N rows as for N rows
+    """
+    small, large = counts[path]
+    assert small == large, f"{path} ran {small} queries for {ROWS} rows and {large} for {2 * ROWS}"
@@ -1,75 +1,178 @@
-"""
-DAO (Data Access Object) file
-
-Helper file containing functions for accessing data in our database
-"""
-
-from db import db, User
-
-
-def get_user_by_email(email):
-    """
-    Returns a user object from the database given an email
-    """
-    return User.query.filter(User.email == email).first()
-
-
-def get_user_by_session_token(session_token):
-    """
-    Returns a user object from the database given a session token
-    """
-    return User.query.filter(User.session_token == session_token).first()
-
-
-def get_user_by_update_token(update_token):
-    """
-    Returns a user object from the database given an update token
-    """
-    return User.query.filter(User.update_token == update_token).first()
-
-
-def verify_credentials(email, password):
-    """
-    Returns true if the credentials match, otherwise returns false
-    """
-    optional_user = get_user_by_email(email)
-
-    if optional_user is None:
-        return False, None
-    
-    return optional_user.verify_password(password), optional_user
-
-
-def create_user(email, password, first, last, phone_number):
-    """
-    Creates a User object in the database
-
-    Returns if creation was successful, and the User object
-    """
-    optional_user = get_user_by_email(email)
-
-    if optional_user is not None:
-        return False, optional_user
-
-    user = User(email = email, password = password, first = first, last = last, phone_number = phone_number)
-
-    db.session.add(user)
-    db.session.commit()
-
-    return True, user
-
-
-def renew_session(update_token):
-    """
-    Renews a user's session token
-    
-    Returns the User object
-    """
-    optional_user = get_user_by_update_token(update_token)
-
-    if optional_user is None:
-        return False, None
-    
-    optional_user.renew_session()
-    db.session.commit()
-    return True, optional_user
+"""
+DAO (Data Access Object) file
+
+Helper file containing functions for accessing data in our database
+"""
+
+import datetime
+import threading
+from collections import OrderedDict
+from os import environ
+
+import passwords
+from db import db, RATES, Rating, User, association_table_rating_postee
+
+SESSION_CACHE_SIZE = int(environ.get("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = datetime.timedelta(seconds=int(environ.get("SESSION_CACHE_TTL", 60)))
+
+# Maps a valid session token to (user id, time the cached entry stops being valid),
+# least recently used first
+_session_cache = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+
+def get_user_by_email(email):
+    """
+    Returns a user object from the database given an email
+    """
+    return User.query.filter(User.email == email).first()
+
+
+def get_user_by_session_token(session_token):
+    """
+    Returns a user object from the database given a session token
+    """
+    return User.query.filter(User.session_token == session_token).first()
+
+
+def get_user_id_by_session_token(session_token):
+    """
+    Returns the id of the user with the given session token if the session is
+    valid, otherwise returns None
+
+    Valid sessions are cached for up to SESSION_CACHE_TTL (never past the
+    session expiration), so most lookups don't touch the database
+    """
+    now = datetime.datetime.now()
+    with _session_cache_lock:
+        cached = _session_cache.get(session_token)
+        if cached is not None:
+            user_id, valid_until = cached
+            if now < valid_until:
+                _session_cache.move_to_end(session_token)
+                return user_id
+            del _session_cache[session_token]
+
+    optional_user = get_user_by_session_token(session_token)
+    if optional_user is None or not optional_user.verify_session_token(session_token):
+        return None
+
+    with _session_cache_lock:
+        _session_cache[session_token] = (optional_user.id, min(optional_user.session_expiration, now + SESSION_CACHE_TTL))
+        _session_cache.move_to_end(session_token)
+        if len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+    return optional_user.id
+
+
+def invalidate_session(session_token):
+    """
+    Removes a session token from the session cache
+    """
+    with _session_cache_lock:
+        _session_cache.pop(session_token, None)
+
+
+def get_user_by_update_token(update_token):
+    """
+    Returns a user object from the database given an update token
+    """
+    return User.query.filter(User.update_token == update_token).first()
+
+
+def verify_credentials(email, password):
+    """
+    Returns true if the credentials match, otherwise returns false
+
+    Rehashes the password if it was hashed with a different cost than the
+    configured one
+    """
+    optional_user = get_user_by_email(email)
+
+    if optional_user is None:
+        return False, None
+
+    if not optional_user.verify_password(password):
+        return False, optional_user
+
+    if passwords.needs_rehash(optional_user.password_digest):
+        optional_user.password_digest = passwords.hash_password(password)
+        db.session.commit()
+    return True, optional_user
+
+
+def create_user(email, password, first, last, phone_number):
+    """
+    Creates a User object in the database
+
+    Returns if creation was successful, and the User object
+    """
+    optional_user = get_user_by_email(email)
+
+    if optional_user is not None:
+        return False, optional_user
+
+    user = User(email = email, password = password, first = first, last = last, phone_number = phone_number)
+
+    db.session.add(user)
+    db.session.commit()
+
+    return True, user
+
+
+def renew_session(update_token):
+    """
+    Renews a user's session token
+    
+    Returns the User object
+    """
+    optional_user = get_user_by_update_token(update_token)
+
+    if optional_user is None:
+        return False, None
+
+    invalidate_session(optional_user.session_token)
+    optional_user.renew_session()
+    db.session.commit()
+    return True, optional_user
+
+
+def end_session(user):
+    """
+    Logs a user out by expiring their session and replacing both of their tokens
+    """
+    invalidate_session(user.session_token)
+    user.renew_session()
+    user.session_expiration = datetime.datetime.now()
+    db.session.commit()
+
+
+def rebuild_rating_totals(check_only=False):
+    """
+    Recomputes the rating totals of every user from their ratings
+
+    Returns the ids of the users whose stored totals were wrong, and fixes
+    them unless check_only is true
+    """
+    totals = {}
+    counts = db.session.query(association_table_rating_postee.c.user_id, Rating.rate, db.func.count()).join(
+        Rating, Rating.id == association_table_rating_postee.c.rating_id
+    ).group_by(association_table_rating_postee.c.user_id, Rating.rate)
+    for user_id, rate, count in counts:
+        user_totals = totals.setdefault(user_id, {"rating_count": 0, "rating_sum": 0})
+        user_totals["rating_count"] += count
+        user_totals["rating_sum"] += count * rate
+        if rate in RATES:
+            user_totals[f"rating_{rate}"] = count
+
+    columns = ["rating_count", "rating_sum"] + [f"rating_{rate}" for rate in RATES]
+    stored = db.session.query(User.id, *[getattr(User, column) for column in columns])
+    wrong = []
+    for row in stored:
+        expected = {column: totals.get(row.id, {}).get(column, 0) for column in columns}
+        if any(getattr(row, column) != expected[column] for column in columns):
+            wrong.append(row.id)
+            if not check_only:
+                User.query.filter_by(id = row.id).update(expected, synchronize_session = False)
+    db.session.commit()
+    return wrong